@@ -16,7 +16,7 @@ logging.basicConfig(format="{levelname: <6} {name: <16} {message}",
 _log = logging.getLogger(__name__)
 del logging, os
 
-import functools
+import asyncio, concurrent.futures, functools, queue, threading, typing
 
 
 __doc__ = """See README."""
@@ -51,20 +51,28 @@ def _parse_ieee1284_id(b: str) -> dict:
         _log.exception('Invalid ID string: %r', b)
 
 
+def _unjson_ieee1284_id(d: dict) -> dict:
+    "Parsed device id as it was before a JSON round-trip (CMD a tuple)"
+    return dict((k, tuple(v) if isinstance(v, list) else v) for (k, v) in d.items())
+
+
 class Device:
 
+    _cache_key: str             # device cache key
+    _fingerprint = None         # checked against cached entries
+
     @property
     def brand(self) -> str|None:
-        i = self.info
+        i = self.quick_info
         return i.get('brand') or i.get('MFG') or i.get('MANUFACTURER') or \
             i.get('manufacturer')
     @property
     def model(self) -> str|None:
-        i = self.info
+        i = self.quick_info
         return i.get('model') or i.get('MDL') or i.get('MODEL') or i.get('product')
     @property
     def serial_number(self) -> str|None:
-        i = self.info
+        i = self.quick_info
         return i.get('SN') or i.get('serial_number')
 
     @property
@@ -75,13 +83,166 @@ class Device:
     def __str__(self):
         return '%s sn:%s' % (self.name, self.serial_number or '?')
 
+    # Identity comes in tiers: descriptors at hand (`_base_info`), then the
+    # printer ID from the device cache, else read from the device on demand
+    # or in the background (`prefetch`).
+
+    _base_info = {}
+
+    @functools.cached_property
+    def info(self):
+        "Descriptors and printer ID, read from the device if not cached"
+        from collections import ChainMap
+        return ChainMap({}, self._base_info, self.id_info)
+
+    @property
+    def quick_info(self):
+        "What is known without device I/O: descriptors, and the printer ID if cached or read"
+        from collections import ChainMap
+        i = self.__dict__.get('id_info')
+        return ChainMap({}, self._base_info, (self._cached_id or {}) if i is None else i)
+
+    @functools.cached_property
+    def id_info(self) -> dict:
+        "Printer ID, from the device cache while fresh (refreshed in the background)"
+        return self._cached_id or self.prefetch().result()
+
+    def prefetch(self) -> concurrent.futures.Future:
+        "Starts reading the printer ID in the background if not known; returns its future"
+        with _prefetch_lock:
+            f = self.__dict__.get('_id_future')
+            if f is None:
+                known = self.__dict__.get('id_info') or self._cached_id
+                if known:
+                    f = concurrent.futures.Future()
+                    f.set_result(known)
+                else:
+                    f = _get_executor().submit(self._load_id)
+                self._id_future = f
+        return f
+
+    @functools.cached_property
+    def _cached_id(self) -> dict|None:
+        from .cache import get_cache
+        c = get_cache()
+        e = c.get(self._cache_key, self._fingerprint)
+        if e and e.get('info'):
+            e['info'] = _unjson_ieee1284_id(e['info'])
+            self._prime(e)
+            if c.stale(e):
+                _get_executor().submit(self._refresh_id, e['info'])
+            return e['info']
+
+    def _load_id(self):
+        info = self._read_id()
+        self.__dict__.setdefault('id_info', info)
+        return info
+
+    def _refresh_id(self, info):
+        if new := self._read_id(refresh=True):
+            info.update(new)
+
+    def _prime(self, entry):
+        "Sets up links with what was cached"
+
+    def _read_id(self, refresh=False) -> dict:
+        "Reads the printer ID from the device, and caches it"
+        raise NotImplementedError
+
     @classmethod
-    def find(cls, timeout=5):
-        "List available printer devices"
-        res = [d for c in cls.__subclasses__() for d in c.ifind(timeout=timeout)]
+    def find(cls, timeout=5, **kw):
+        "List available printer devices (see `ifind`)"
+        res = list(Device.ifind(timeout=timeout, **kw))
         _log.info('Found %i devices', len(res))
         return res
 
+    @classmethod
+    def ifind(cls, timeout=5, limit=None, serial_number=None, **kw):
+        """Yields printer devices as they are found, all sources scanning in parallel
+
+        limit -- stop after that many devices
+        serial_number -- only yield the device with this serial number, then stop
+        kw -- source options, e.g. networks: CIDRs to sweep (see `sweep`)
+        """
+        q = queue.Queue()
+        stop = threading.Event()
+        running, n = cls._scan(q.put, stop, timeout, serial_number, **kw), 0
+        seen = set()            # several sources may find the same device
+        try:
+            while running:
+                d = q.get()
+                if d is None:
+                    running -= 1
+                    continue
+                if repr(d) in seen:
+                    continue
+                seen.add(repr(d))
+                yield d
+                n += 1
+                if serial_number is not None or (limit and n >= limit):
+                    return
+        finally:
+            stop.set()
+
+    @classmethod
+    async def afind(cls, timeout=5, limit=None, serial_number=None, **kw):
+        "Async `ifind`"
+        q = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        def put(d):
+            try:
+                loop.call_soon_threadsafe(q.put_nowait, d)
+            except RuntimeError: # loop closed, after the caller left
+                pass
+        stop = threading.Event()
+        running, n = cls._scan(put, stop, timeout, serial_number, **kw), 0
+        seen = set()
+        try:
+            while running:
+                d = await q.get()
+                if d is None:
+                    running -= 1
+                    continue
+                if repr(d) in seen:
+                    continue
+                seen.add(repr(d))
+                yield d
+                n += 1
+                if serial_number is not None or (limit and n >= limit):
+                    return
+        finally:
+            stop.set()
+
+    @staticmethod
+    def _scan(put, stop, timeout, serial_number=None, **kw) -> int:
+        """Scans all sources, each in a thread, until `stop` is set
+
+        Devices are passed to `put`, then None when a source is done.
+        Returns the number of sources.
+        """
+        def scan(source):
+            try:
+                for d in source:
+                    if stop.is_set():
+                        break
+                    if serial_number is not None:
+                        d.id_info # may hold the serial number
+                    if serial_number is None or d.serial_number == serial_number:
+                        put(d)
+            except:
+                _log.exception('Device discovery failed')
+            finally:
+                put(None)
+        sources = [s for c in Device.__subclasses__() for s in c._sources(timeout, stop, **kw)]
+        for s in sources:
+            threading.Thread(target=scan, args=(s,), daemon=True).start()
+        return len(sources)
+
+    @classmethod
+    def _sources(cls, timeout, stop, **kw) -> list[typing.Iterable]:
+        "Iterables of devices to scan in parallel"
+        return [cls.ifind(timeout=timeout)] if 'ifind' in vars(cls) else []
+
     @staticmethod
     def from_file(fname):
         return UsbDevice(FileIO(fname))
@@ -98,28 +259,74 @@ class UsbDevice(Device):
 
     @classmethod
     def ifind(cls, **kw):
+        for s in cls._sources():
+            yield from s
+
+    @classmethod
+    def _sources(cls, timeout=None, stop=None, **kw):
         from .usb import UsbIO
-        for c in (FileIO, UsbIO):
-            for i in c.ifind():
-                yield cls(i)
+        return [(cls(i) for i in c.ifind()) for c in (FileIO, UsbIO)]
 
     def __init__(self, io):
         self.io = io
 
-    @functools.cached_property
-    def info(self):
-        from collections import ChainMap
-        return ChainMap({}, self.io.info, self.epson.info)
+    @property
+    def _base_info(self):
+        return self.io.info
+
+    @property
+    def _cache_key(self):
+        return str(self.io)
+
+    @property
+    def _fingerprint(self):
+        return getattr(self.io, 'fingerprint', None)
+
+    def _prime(self, entry):
+        self._epson.__dict__.setdefault('info', entry['info'])
+
+    def _read_id(self, refresh=False):
+        from .cache import get_cache
+        from .epson import EpsonD4
+        driver = EpsonD4(self.d4) if refresh else self._epson
+        # not through cached properties, locked across instances before Python 3.12
+        info = driver.__dict__.get('info')
+        if info is None:
+            info = driver.__dict__.setdefault('info', driver.read_info())
+        if info:
+            get_cache().put(self._cache_key, self._fingerprint, info=info,
+                            revision=self.d4.revision)
+        return info
 
     @functools.cached_property
     def d4(self):
         from .d4 import D4Link
-        return D4Link(self.io)
+        from .cache import get_cache
+        link = D4Link(self.io)
+        e = get_cache().get(self._cache_key, self._fingerprint)
+        if e and 'revision' in e:
+            link.revision = e['revision']
+        return link
 
     @functools.cached_property
     def epson(self):
+        from .epson import get_db
+        i = self.io.info
+        e = self._epson
+        if name := e._guess_model(model=i.get('product'), idProduct=i.get('idProduct')):
+            e.spec = get_db().spec(name) # no device I/O
+            return e
+        self.id_info            # the printer ID decides: read once, shared with `info`
+        return e.configure(True)
+
+    @functools.cached_property
+    def _epson(self):
         from .epson import EpsonD4
-        return EpsonD4(self.d4).configure()
+        return EpsonD4(self.d4)
+
+    def session(self, **kw):
+        "Keep the control channel open across operations (see `d4.Session`)"
+        return self.d4.session(self._epson.ctrl_channel, **kw)
 
     def __str__(self):
         return super().__str__() + f' @{self.io}'
@@ -131,20 +338,63 @@ class UsbDevice(Device):
 class NetworkDevice(Device):
 
     @classmethod
-    def ifind(cls, timeout=5):
-        from .zeroconf import find
-        for (ip, name) in find(timeout):
+    def ifind(cls, timeout=5, stop=None):
+        from .zeroconf import ifind
+        for (ip, name) in ifind(timeout, stop):
             if ':' not in ip:   # ignore IPv6, not supported by pysnmp
                 yield cls(ip, name=name)
 
+    @classmethod
+    def _sources(cls, timeout, stop, networks=(), **kw):
+        return [cls.ifind(timeout, stop), cls.icached(stop),
+                *(cls.isweep(n, stop) for n in networks)]
+
+    @classmethod
+    def isweep(cls, network, stop=None, **kw):
+        "Yields devices answering SNMP in `network` (see `sweep.asweep`)"
+        from .sweep import isweep
+        from .cache import get_cache
+        for (ip, info) in isweep(network, stop, **kw):
+            get_cache().put(f'ip:{ip}', info=info)
+            yield cls(ip)
+
+    @classmethod
+    def icached(cls, stop=None):
+        "Yields devices of the device cache that still answer"
+        from .cache import get_cache
+        ips = [k[3:] for (k, e) in get_cache().items('ip:')]
+        if ips:
+            yield from cls.isweep(ips, stop, brand=None, timeout=0.5, retries=0)
+
     def __init__(self, ip, **kw):
         self.ip = ip
         self.__dict__.update(kw)
 
-    @functools.cached_property
-    def info(self):
-        from collections import ChainMap
-        return ChainMap({}, self.snmp.info, self.epson.info)
+    @property
+    def _base_info(self):
+        return {'ip': self.ip}
+
+    @property
+    def _cache_key(self):
+        return f'ip:{self.ip}'
+
+    def _prime(self, entry):
+        self.snmp.__dict__.setdefault('info', entry['info'])
+
+    def _read_id(self, refresh=False):
+        from .cache import get_cache
+        from .snmp import SNMPLink
+        link = self.snmp
+        if refresh:
+            link = SNMPLink(self.ip, link.port, link.version, link.user)
+        try:
+            info = link._loop.run_until_complete(link.ainfo())
+        finally:
+            if refresh:
+                link.close()
+        if info:
+            get_cache().put(self._cache_key, info=info)
+        return info
 
     @functools.cached_property
     def snmp(self):
@@ -154,6 +404,7 @@ class NetworkDevice(Device):
     @functools.cached_property
     def epson(self):
         from .epson import EpsonSNMP
+        self.id_info
         return EpsonSNMP(self.snmp).configure()
 
     def __str__(self):
@@ -163,6 +414,17 @@ class NetworkDevice(Device):
         return f"{self.__class__.__name__}({self.ip!r})"
 
 
+_prefetch_lock = threading.Lock()
+_executor = None
+
+def _get_executor() -> concurrent.futures.Executor:
+    "Shared pool reading printer IDs"
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(8, 'reinkpy-id')
+    return _executor
+
+
 class FileIO:
 
     @classmethod
@@ -184,6 +446,13 @@ class FileIO:
     def info(self):
         return {'file_path': self.path}
 
+    @property
+    def fingerprint(self):
+        "Changes when the device node is re-created (e.g. printer plugged again)"
+        import os
+        st = os.stat(self.path)
+        return (st.st_rdev, st.st_ctime)
+
     # def probe(self):
     #     with self:
     #         # IEEE 1284.1 RDC Request Summary cmd
@@ -209,7 +478,8 @@ class FileIO:
     def write(self, data):
         return self._f.write(data)
 
-    def read(self, size=None):
+    def read(self, size=None, timeout=None):
+        # timeout: not supported, relies on the driver's own
         return self._f.read(size)
 
     def __str__(self):
@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Minimal BER codec for SNMP v1/v2c GET requests and their responses"""
+__all__ = (
+    'encode_get',
+    'decode_response',
+    'encode_oid',
+    'decode_oid',
+    'tlv_size',
+    'ERRORS',
+)
+
+import functools
+
+
+INTEGER, OCTET_STRING, NULL, OID, SEQUENCE = 0x02, 0x04, 0x05, 0x06, 0x30
+GET_REQUEST, GET_RESPONSE = 0xa0, 0xa2
+IPADDRESS, COUNTER32, GAUGE32, TIMETICKS, OPAQUE, COUNTER64 = 0x40, 0x41, 0x42, 0x43, 0x44, 0x46
+# other tags decode to None: Null, noSuchObject 0x80, noSuchInstance 0x81, endOfMibView 0x82
+
+VERSIONS = {'1': 0, '2c': 1}
+
+ERRORS = ('noError', 'tooBig', 'noSuchName', 'badValue', 'readOnly', 'genErr',
+          'noAccess', 'wrongType', 'wrongLength', 'wrongEncoding', 'wrongValue',
+          'noCreation', 'inconsistentValue', 'resourceUnavailable', 'commitFailed',
+          'undoFailed', 'authorizationError', 'notWritable', 'inconsistentName')
+
+
+def tlv_size(n: int) -> int:
+    "Size of a value of n bytes, with its tag and length"
+    return n + (2 if n < 0x80 else 3 if n < 0x100 else 4)
+
+
+def _length(n):
+    if n < 0x80:
+        return bytes((n,))
+    b = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(b),)) + b
+
+
+def _tlv(tag, content):
+    return bytes((tag,)) + _length(len(content)) + content
+
+
+def _int(v):
+    return _tlv(INTEGER, v.to_bytes(v.bit_length() // 8 + 1, 'big', signed=True))
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_oid(oid: str) -> bytes:
+    "Dotted OID -> BER (with tag and length)"
+    arcs = [int(a) for a in oid.strip('.').split('.')]
+    out = bytearray((40 * arcs[0] + arcs[1],))
+    for a in arcs[2:]:
+        sub = [a & 0x7f]
+        while a := a >> 7:
+            sub.append(0x80 | a & 0x7f)
+        out += bytes(reversed(sub))
+    return _tlv(OID, bytes(out))
+
+
+def decode_oid(b: bytes) -> str:
+    "BER OID content -> dotted OID"
+    arcs = list(divmod(b[0], 40)) if b[0] < 80 else [2, b[0] - 80]
+    a = 0
+    for c in b[1:]:
+        a = a << 7 | c & 0x7f
+        if not c & 0x80:
+            arcs.append(a)
+            a = 0
+    return '.'.join(map(str, arcs))
+
+
+def encode_get(request_id: int, oids, community: bytes = b'public',
+               version: int = 0) -> bytes:
+    "Returns a GetRequest message for oids"
+    vbs = b''.join(_tlv(SEQUENCE, encode_oid(o) + b'\x05\x00') for o in oids)
+    pdu = _tlv(GET_REQUEST, _int(request_id) + b'\x02\x01\x00\x02\x01\x00'
+               + _tlv(SEQUENCE, vbs))
+    return _tlv(SEQUENCE, _int(version) + _tlv(OCTET_STRING, community) + pdu)
+
+
+def _read(b, i):
+    "Returns (tag, start, end) of the value at b[i]"
+    tag, n = b[i], b[i+1]
+    i += 2
+    if n & 0x80:
+        k = n & 0x7f
+        n = int.from_bytes(b[i:i+k], 'big')
+        i += k
+    if i + n > len(b):
+        raise ValueError('Truncated BER value')
+    return tag, i, i + n
+
+
+def _value(tag, c):
+    if tag in (OCTET_STRING, IPADDRESS, OPAQUE):
+        return bytes(c)
+    if tag == INTEGER:
+        return int.from_bytes(c, 'big', signed=True)
+    if tag in (COUNTER32, GAUGE32, TIMETICKS, COUNTER64):
+        return int.from_bytes(c, 'big')
+    if tag == OID:
+        return decode_oid(c)
+    return None
+
+
+def decode_response(b: bytes) -> tuple:
+    """Returns (version, community, request_id, error_status, error_index, [(oid, value)])
+
+    Values are bytes, int, dotted str or None. Raises ValueError on
+    malformed messages or other PDUs than GetResponse.
+    """
+    try:
+        tag, i, end = _read(b, 0)
+        if tag != SEQUENCE:
+            raise ValueError('Not an SNMP message')
+        head = []
+        for expected in (INTEGER, OCTET_STRING):
+            tag, s, i = _read(b, i)
+            if tag != expected:
+                raise ValueError('Unexpected tag %02x' % tag)
+            head.append(b[s:i])
+        tag, i, end = _read(b, i)
+        if tag != GET_RESPONSE:
+            raise ValueError('Not a GetResponse PDU (%02x)' % tag)
+        for _ in range(3):
+            tag, s, i = _read(b, i)
+            head.append(int.from_bytes(b[s:i], 'big', signed=True))
+        tag, i, end = _read(b, i)
+        vbs = []
+        while i < end:
+            _, s, i = _read(b, i)
+            _, os, oe = _read(b, s)
+            tag, vs, ve = _read(b, oe)
+            vbs.append((decode_oid(b[os:oe]), _value(tag, b[vs:ve])))
+    except IndexError:
+        raise ValueError('Truncated SNMP message') from None
+    version, community, *rest = head
+    return (int.from_bytes(version, 'big'), bytes(community), *rest, vbs)
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Persistent cache of device identities
+
+Entries are keyed by device location (USB port, file path or IP) and hold
+the parsed IEEE 1284 ID, the D4 protocol revision agreed on, and a
+`check` fingerprint (for USB: the device descriptors). An entry is used
+while it is younger than `ttl` and its fingerprint matches the device's.
+
+Changes are written on `flush` (and at exit), merged into the entries
+other processes saved meanwhile.
+"""
+__all__ = (
+    'Cache',
+    'get_cache',
+)
+
+from . import helpers
+import atexit, json, os, threading, time
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+class Cache:
+
+    ttl = 7 * 24 * 3600         # s
+    refresh_after = 24 * 3600   # s, age from which entries are refreshed in the background
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(helpers.cache_dir(), 'devices.json')
+        self._lock = threading.RLock()
+        self._entries = None
+        self._changed = set()   # keys put or discarded since the last save
+        atexit.register(self.flush)
+
+    @property
+    def entries(self) -> dict:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return self._entries
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            _log.warn('Ignoring device cache %s: %s', self.path, e)
+            return {}
+
+    def get(self, key, check=None) -> dict|None:
+        "Returns the entry for key if fresh and its fingerprint matches `check`"
+        e = self.entries.get(key)
+        if e and time.time() - e['time'] < self.ttl and e.get('check') == _plain(check):
+            return e
+
+    def stale(self, entry) -> bool:
+        "Whether entry is due for a refresh"
+        return time.time() - entry['time'] > self.refresh_after
+
+    def items(self, prefix=''):
+        "Yields (key, entry) of fresh entries"
+        now = time.time()
+        for (k, e) in list(self.entries.items()):
+            if k.startswith(prefix) and now - e['time'] < self.ttl:
+                yield k, e
+
+    def put(self, key, check=None, **data):
+        "Sets data of an entry, dropping what it held for another fingerprint"
+        check = _plain(check)
+        with self._lock:
+            e = self.entries.get(key)
+            if e is None or e.get('check') != check:
+                e = self.entries[key] = {}
+            e.update(_plain(data), time=time.time(), check=check)
+            self._changed.add(key)
+
+    def discard(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._changed.add(key)
+
+    def flush(self):
+        "Saves the changes, if any"
+        with self._lock:
+            if self._changed:
+                self.save()
+
+    def save(self):
+        "Writes the entries (atomically), over those saved by others but for the keys changed here"
+        with self._lock:
+            entries = self._load()
+            for k in self._changed:
+                if k in self.entries:
+                    entries[k] = self.entries[k]
+                else:
+                    entries.pop(k, None)
+            self._entries = entries
+            tmp = '%s.%i.tmp' % (self.path, os.getpid())
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp, self.path)
+                self._changed.clear()
+            except OSError as e:
+                _log.warn('Saving device cache failed: %s', e)
+
+
+def _plain(o):
+    "As read back from JSON"
+    return json.loads(json.dumps(o))
+
+
+_cache = None
+
+def get_cache() -> Cache:
+    global _cache
+    if _cache is None:
+        _cache = Cache()
+    return _cache
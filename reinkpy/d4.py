@@ -2,36 +2,94 @@
 """A partial and rough implementation of IEEE 1284.4"""
 __all__ = (
     'D4Link',
+    'Decoder',
+    'Session',
     'decode',
+    'decode_stream',
 )
 
 from . import helpers
 
-import collections, contextlib, struct, time
+import atexit, collections, contextlib, mmap, struct, threading, time
 import logging
 _log = logging.getLogger(__name__)
 del logging
 
 
-DELAY = 0.0
+DELAY = 0.0 # minimal delay between commands (s)
+
+
+class Packet:
+    "Base for packet types, with named fields in `__slots__`"
+    __slots__ = ()
+    name = None
+    fields = ()
+
+    def astuple(self):
+        return ()
+
+    def __iter__(self):
+        return iter(self.astuple())
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, i):
+        return self.astuple()[i]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.astuple() == other.astuple()
+
+    def __hash__(self):
+        return hash((type(self), self.astuple()))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.name, ', '.join(
+            '%s=%r' % fv for fv in zip(self.fields, self.astuple())))
+
+
+def _make_packet_type(name, fields, defaults=(), base=Packet):
+    "Returns a `base` subclass with slots for `fields` (like a namedtuple)"
+    fields = tuple(fields.replace(',', ' ').split())
+    nreq = len(fields) - len(defaults)
+    args = ', '.join(f if i < nreq else '%s=_d[%i]' % (f, i - nreq)
+                     for (i, f) in enumerate(fields))
+    src = 'def __init__(self, %s):\n    %s\n' % (args, '; '.join(
+        'self.%s = %s' % (f, f) for f in fields) or 'pass')
+    src += 'def astuple(self):\n    return (%s)\n' % ''.join('self.%s, ' % f for f in fields)
+    ns = {}
+    exec(src, {'_d': tuple(defaults)}, ns)
+    return type(name, (base,), dict(ns, __slots__=fields, name=name, fields=fields))
+
+
+class _Header(Packet):
+    __slots__ = ()
+    hLen = 0
+    cid = property(lambda self: (self.psid, self.ssid))
+    payload_length = property(lambda self: self.length - self.hLen)
 
 
 class D4Link:
 
     CMD_ENTER_D4: bytes = None
     CMD_ENTER_D4_REPLY: bytes = None
+    timeout = 5.0 # time allowed for a reply (s)
+    revision = 0x20 # transaction protocol revision tried first, then agreed on
 
     class protocol:
-        hTuple = collections.namedtuple('D4PacketHeader', 'psid ssid length credit control')
+        hTuple = _make_packet_type('D4PacketHeader', 'psid ssid length credit control',
+                                   base=_Header)
         hStruct = struct.Struct('>BBHBB')
-        hLen = hTuple.hLen = struct.calcsize(hStruct.format) # 6
-        hTuple.payload_length = property(lambda self: self.length - self.hLen)
-        hTuple.cid = property(lambda self: self[:2])
+        hLen = hTuple.hLen = hStruct.size # 6
 
         @classmethod
         def decode(cls, b):
             "Returns (header, payload)"
-            return cls.hTuple(*cls.hStruct.unpack(b[:cls.hLen])), b[cls.hLen:]
+            return cls.hTuple(*cls.hStruct.unpack_from(b)), b[cls.hLen:]
+
+        @classmethod
+        def decode_header(cls, b, offset=0):
+            return cls.hTuple(*cls.hStruct.unpack_from(b, offset))
 
         @classmethod
         def encode(cls, payload=b'', psid=0, ssid=0, credit=1, control=0):
@@ -42,34 +100,52 @@ class D4Link:
     def __init__(self, target):
         self.target = target
         self._init_channels()
+        self._rbuf = PacketBuffer(self.protocol)
         self._nctx = 0
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.pacer = Pacer()
+        self.credits = CreditManager(self)
 
     def _init_channels(self):
         self.channels = {}      # (psid, ssid): channel
         self.txn = self.channels[TXChannel.cid] = TXChannel(self)
 
     def __enter__(self):
-        if self._nctx == 0:
-            self._exit_stack = contextlib.ExitStack()
-            self._exit_stack.enter_context(self.target)
-            if self.CMD_ENTER_D4:
-                _log.info('Entering IEEE 1284.4 mode...')
-                assert self.target.write(self.CMD_ENTER_D4)
-                r = b''
-                for i in range(5):
-                    r += self.target.read()
-                    if self.CMD_ENTER_D4_REPLY in r:
-                        break
-                else:
-                    _log.warn('Entering IEEE 1284.4 mode failed with response: %r' % r)
-            if not self._send_init():
-                raise Exception('Init failed')
-        self._nctx += 1
-        return self
+        with self.lock:
+            if self._nctx == 0:
+                self._exit_stack = contextlib.ExitStack()
+                self._exit_stack.enter_context(self.target)
+                try:
+                    if self.CMD_ENTER_D4:
+                        _log.info('Entering IEEE 1284.4 mode...')
+                        assert self.target.write(self.CMD_ENTER_D4)
+                        r = b''
+                        deadline = helpers.Deadline(self.timeout)
+                        while True:
+                            resp = self.target.read(timeout=deadline.remaining())
+                            r += resp
+                            if self.CMD_ENTER_D4_REPLY in r:
+                                self._rbuf.feed(r.partition(self.CMD_ENTER_D4_REPLY)[2])
+                                break
+                            if deadline.expired:
+                                _log.warn('Entering IEEE 1284.4 mode failed with response: %r' % r)
+                                break
+                            if not resp:
+                                time.sleep(min(0.005, deadline.remaining()))
+                    self.txn.protocol = REVISIONS.get(self.revision, protocol_0x20)
+                    if not self._send_init(self.revision):
+                        raise Exception('Init failed')
+                except:
+                    self._exit_stack.close()
+                    raise
+            self._nctx += 1
+            return self
 
     def _send_init(self, revision=0x20):
         res, rev = self.txn('Init', revision)
         if res == 0x00:
+            self.revision = revision
             return True
             # return self.txn('OpenChannel', 0, 0)  # needed in rev 0x10?
         elif res in (0x01, 0x0B):
@@ -77,55 +153,61 @@ class D4Link:
             raise NotImplemented
         elif res == 0x02:
             if rev != revision:
-                if rev == 0x10:
-                    self.txn.protocol = protocol_0x10
-                elif rev == 0x20:
-                    self.txn.protocol = protocol_0x20
-                else:
+                if rev not in REVISIONS:
                     _log.error('Unknown revision %s', rev)
                     return
+                self.txn.protocol = REVISIONS[rev]
                 return self._send_init(rev)
 
     def __exit__(self, *exc):
-        self._nctx -= 1
-        if self._nctx == 0:
-            if self.txn('Exit'):
-                self.txn.credit = 0
-                _log.info('Exit OK')
-            else:
-                _log.error('Exit failed')
-            self._exit_stack.close()
+        with self.lock:
+            self._nctx -= 1
+            if self._nctx == 0:
+                try:
+                    self.txn('Exit')
+                    self.txn.credit = 0
+                    _log.info('Exit OK')
+                except TimeoutError:
+                    _log.error('Exit failed')
+                finally:
+                    self._exit_stack.close()
 
     # def __call__(self, *a, **kw):
     #     return self.txn(*a, **kw)
 
-    def send(self, payload, channel, credit=1, control=0, cost=1, check=True):
-        if check:
-            for retry in range(3):
-                if channel.credit >= cost: # TODO: retry in loop?
-                    break
-                self.txn('CreditRequest', *channel.cid)
-                # self.txn('Credit', *channel.cid, 1)
-            else:
-                _log.error('Missing credits to send on %s', (channel.cid,))
-                return
-        channel.credit -= cost
+    def send(self, payload, channel, credit=1, control=0, cost=1, check=True, pace=True):
+        if check and not self.credits.ensure(channel, cost):
+            _log.error('Missing credits to send on %s', (channel.cid,))
+            return
+        self.credits.consume(channel, cost)
+        if pace:
+            self.pacer.wait()
+        self.last_used = time.monotonic()
         b = self.protocol.encode(payload, *channel.cid, credit, control)
         _log.debug('Sending on %s: %s', channel.cid, helpers.hexdump(b, prefix='\n<<'))
         return self.target.write(b)
 
-    def retreive(self, retries=6): # needs grouping packets->message?
-        rest = getattr(self, '_received', b'')
-        for i in range(1 + retries):
-            resp = self.target.read()
+    def retreive(self, deadline=None):
+        """Read until at least one packet is complete and dispatch all complete packets
+
+        Returns the number of packets dispatched, 0 if `deadline` passed.
+        """
+        if deadline is None:
+            deadline = helpers.Deadline(self.timeout)
+        while True:
+            resp = self.target.read(timeout=deadline.remaining())
             if resp:
-                rest += resp
-                header, payload = self.protocol.decode(rest)
-                if len(payload) < header.payload_length:
-                    continue
-                payload, rest = payload[:header.payload_length], payload[header.payload_length:]
-                self._received = rest
-                return self._on_received(header, payload)
+                self._rbuf.feed(resp)
+                n = 0
+                for (header, payload) in self._rbuf:
+                    self._on_received(header, payload)
+                    n += 1
+                if n:
+                    return n
+            if deadline.expired:
+                return 0
+            if not resp:
+                time.sleep(min(0.005, deadline.remaining()))
 
     def _on_received(self, header, payload): # dispatch to channels
         _log.debug('Received packet in %s: %s', header, helpers.hexdump(payload, prefix='\n>>'))
@@ -133,10 +215,15 @@ class D4Link:
             _log.warning('Ignoring packet received on unknown channel: %s', header.cid)
             return
         c = self.channels[header.cid]
-        c.credit += header.credit # piggybacked
+        if header.credit: # piggybacked
+            self.credits.grant(c, header.credit)
         if payload:
             return c.on_received(payload, header)
 
+    def session(self, *channels, **kw):
+        "Keep the link and `channels` open across operations (see `Session`)"
+        return Session(self, *channels, **kw)
+
     def get_channel(self, serviceName=None, cid=None):
         if serviceName is None and cid is None:
             raise ValueError('A service name or channel ID is required')
@@ -165,40 +252,76 @@ class D4Link:
         return c
 
 
+class PacketBuffer:
+    """Reassembles packets from a byte stream.
+
+    Received bytes are appended to a `bytearray`; iterating yields each
+    complete (header, payload) and consumed bytes are only discarded once
+    they make up most of the buffer.
+    """
+
+    def __init__(self, protocol=D4Link.protocol):
+        self.protocol = protocol
+        self._buf = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        "Number of buffered bytes not yet consumed"
+        return len(self._buf) - self._pos
+
+    def feed(self, b):
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += b
+
+    def __iter__(self):
+        hLen = self.protocol.hLen
+        while len(self._buf) - self._pos >= hLen:
+            header = self.protocol.decode_header(self._buf, self._pos)
+            if header.length < hLen:
+                _log.warning('Skipping byte before invalid header: %s', header)
+                self._pos += 1
+                continue
+            end = self._pos + header.length
+            if end > len(self._buf):
+                return
+            with memoryview(self._buf) as m:
+                payload = bytes(m[self._pos + hLen:end])
+            self._pos = end
+            yield header, payload
+
+
 def _make_tx_command(code, name, sformat, fields, defaults=()):
-    hTuple = collections.namedtuple('%s' % name, fields, defaults=defaults)
+    hTuple = _make_packet_type(name, fields, defaults)
     hTuple.code = code
-    hTuple.name = name
 
     hStruct = struct.Struct('>' + sformat.replace('*', ''))
-    hFormat = hStruct.format
-    hLen = struct.calcsize(hStruct.format)
-    star = fields[-1] if sformat.endswith('*') else None # serviceName
+    hLen = hStruct.size
+    star = sformat.endswith('*') # serviceName
+    # for truncated replies: prefixes of the format, longest first
+    partial = [struct.Struct(hStruct.format[:i]) for i in range(len(hStruct.format)-1, 1, -1)]
+    prefix = bytes((code,))
 
-    def decode(b):
-        if len(b) < hLen and not star:
-            # _log.debug('Decoding truncated commmand: %s', b.hex())
-            for sCap in range(len(hFormat)-1,1,-1):
-                bCap = struct.calcsize(hFormat[:sCap])
-                if bCap <= len(b):
-                    return hTuple(*struct.unpack(hFormat[:sCap], b[:bCap]))
-        f = hStruct.unpack(b[:hLen])
+    def decode(b, offset=0):
         if star:
-            return hTuple(*f, b[hLen:].decode('ascii'))
-        else:
-            return hTuple(*f)
+            return hTuple(*hStruct.unpack_from(b, offset), str(b[offset+hLen:], 'ascii'))
+        if len(b) - offset < hLen:
+            # _log.debug('Decoding truncated commmand: %s', b.hex())
+            for p in partial:
+                if p.size <= len(b) - offset:
+                    return hTuple(*p.unpack_from(b, offset))
+        return hTuple(*hStruct.unpack_from(b, offset))
     hTuple.decode = staticmethod(decode)
 
     if star:
         def encode(*a, **kw):
-            t = hTuple(*a, **kw)
-            # _log.debug('Encoding: %s', t)
-            return (code.to_bytes(1, 'big') + hStruct.pack(*t[:-1]) + t[-1].encode('ascii'))
+            t = hTuple(*a, **kw).astuple()
+            return prefix + hStruct.pack(*t[:-1]) + t[-1].encode('ascii')
     else:
+        pack = hStruct.pack
         def encode(*a, **kw):
-            t = hTuple(*a, **kw)
-            # _log.debug('Encoding: %s', t)
-            return code.to_bytes(1, 'big') + hStruct.pack(*t)
+            return prefix + pack(*hTuple(*a, **kw).astuple())
     hTuple.encode = staticmethod(encode)
 
     return hTuple
@@ -208,8 +331,7 @@ def _make_tx_command(code, name, sformat, fields, defaults=()):
 class protocol:
     @classmethod
     def decode(cls, b):
-        cmd = cls.cmd_by_code[struct.unpack('B', b[:1])[0]]
-        return cmd.decode(b[1:])
+        return cls.cmd_by_code[b[0]].decode(b, 1)
 
     @classmethod
     def encode(cls, cmd, *a, **kw):
@@ -225,6 +347,10 @@ class protocol:
         (0x86, ' Piggybacked credit received in a data packet caused a credit overflow for that channel.'),
         (0x87, ' A reserved or deprecated IEEE 1284.4 command or reply was received. Any piggybacked credit was ignored.')))
 
+    # field holding the credit asked for, by command
+    CREDIT_FIELDS = {'OpenChannel': 'maxCredit', 'CreditRequest': 'maxCredit'}
+    CREDIT_WANT = 8 # credit first asked for on a channel
+
 class protocol_0x20(protocol):
     "Transaction channel protocol revision 0x20"
     cmd_by_name = dict((args[1], _make_tx_command(*args)) for args in (
@@ -264,7 +390,7 @@ class protocol_0x10(protocol):
         (0x82, 'CloseChannelReply',   'BBB',   'result sidP sidS'),
         (0x03, 'Credit',              'BBH',   'sidP sidS addCredit'),
         (0x83, 'CreditReply',         'BBB',   'result sidP sidS'),
-        (0x04, 'CreditRequest',       'BBHH',  'sidP sidS x1 x2', (0x0080, 0xffff)),
+        (0x04, 'CreditRequest',       'BBHH',  'sidP sidS x1 x2', (0x0080, 0xffff)), # requested, max outstanding
         (0x84, 'CreditRequestReply',  'BBBH',  'result sidP sidS addCredit'),
         (0x08, 'Exit',                '',      ''),
         (0x88, 'ExitReply',           'B',     'result'),
@@ -275,8 +401,104 @@ class protocol_0x10(protocol):
         (0x7F, 'Error',               'BBB',   'errorPSID errorSSID errorCode')
     ))
     cmd_by_code = dict((c.code, c) for c in cmd_by_name.values())
+    CREDIT_FIELDS = {'OpenChannel': 'maxCredit', 'CreditRequest': 'x1'}
+    CREDIT_WANT = 0x80 # as the CreditRequest default
+
+REVISIONS = {0x20: protocol_0x20, 0x10: protocol_0x10}
+
 
 
+class CreditManager:
+    """Tracks the credit granted by the peer and consumed on each channel.
+
+    Credit is asked for in bulk, when opening a channel and in each
+    CreditRequest, starting from `want` (default: the protocol's
+    `CREDIT_WANT`). The amount asked for a channel doubles (up to
+    `max_want`) whenever it ran low on credit while sending.
+    """
+
+    def __init__(self, link, want=None, max_want=0x80, low=1):
+        self.link = link
+        self.initial_want = want
+        self.max_want = max_want
+        self.low = low
+        self.want = {}
+        self.granted = collections.Counter()
+        self.consumed = collections.Counter()
+
+    def grant(self, channel, n):
+        channel.credit += n
+        self.granted[channel.cid] += n
+
+    def consume(self, channel, n):
+        channel.credit -= n
+        self.consumed[channel.cid] += n
+
+    def request_kw(self, cmd, channel):
+        "Keyword argument asking for credit in `cmd` transactions"
+        p = self.link.txn.protocol
+        return {p.CREDIT_FIELDS[cmd]:
+                self.want.setdefault(channel.cid, self.initial_want or p.CREDIT_WANT)}
+
+    def request(self, channel, grow=True, n=None):
+        "Asks for `n` credit (default: what `channel` wants)"
+        kw = self.request_kw('CreditRequest', channel)
+        if n is not None:
+            kw = dict.fromkeys(kw, n)
+        self.link.txn('CreditRequest', *channel.cid, **kw)
+        if grow:
+            self.want[channel.cid] = min(self.max_want, 2 * self.want[channel.cid])
+
+    def refill(self, channel):
+        "Request credit ahead, when `channel` has `low` or less"
+        if channel.credit <= self.low:
+            try:
+                self.request(channel)
+            except TimeoutError:    # ensure() asks again when out
+                _log.warning('Credit refill failed on %s', channel.name)
+
+    def ensure(self, channel, cost=1):
+        "Request credit until `channel` has `cost`"
+        for retry in range(3):
+            if channel.credit >= cost:
+                return True
+            try:
+                self.request(channel)
+            except TimeoutError:
+                _log.warning('Credit request failed on %s', channel.name)
+        return channel.credit >= cost
+
+
+class Pacer:
+    """Paces the commands sent on a link.
+
+    Keeps moving averages of the reply latency and of the error rate (lost
+    replies, Error packets). Commands are spaced by `DELAY` plus a gap
+    proportional to both, so a device that drops replies gets time to recover.
+    """
+    alpha = 0.2 # weight of the last measure
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self._last = 0.0
+
+    def record(self, latency=None, error=False):
+        a = self.alpha
+        if latency is not None:
+            self.latency = latency if self.latency is None else (1-a)*self.latency + a*latency
+        self.error_rate = (1-a)*self.error_rate + a*bool(error)
+
+    @property
+    def gap(self):
+        return DELAY + 4 * (self.latency or 0.0) * self.error_rate
+
+    def wait(self):
+        t = self._last + self.gap - time.monotonic()
+        if t > 0:
+            time.sleep(t)
+        self._last = time.monotonic()
+
 
 class TXChannel:
     cid = (0x00, 0x00)
@@ -296,18 +518,24 @@ class TXChannel:
         self.link.__exit__(*exc)
 
     def __call__(self, cmd, *a, **kw):
-        ok = self.send(cmd, *a, **kw)
-        self._received = None
-        time.sleep(DELAY)
-        for r in range(8):
-            self.link.retreive()
-            if self._received:
-                p = self._received
-                if p.name == cmd + 'Reply':
+        "Run a transaction. Raises TimeoutError if no reply comes in time."
+        with self.link.lock:
+            ok = self.send(cmd, *a, **kw)
+            sent = time.monotonic()
+            deadline = helpers.Deadline(self.link.timeout)
+            self._received = None
+            while True:
+                self.link.retreive(deadline)
+                p, self._received = self._received, None
+                if p and p.name == cmd + 'Reply':
+                    self.link.pacer.record(time.monotonic() - sent)
                     return p
-                else:
+                elif p:
                     _log.debug('TX: dropping packet (not a %s): %s', cmd+'Reply', p)
-        _log.warning('TX: did not receive expected %s', cmd+'Reply')
+                if deadline.expired:
+                    break
+            self.link.pacer.record(error=True)
+            raise TimeoutError('TX: did not receive expected %s' % (cmd+'Reply'))
 
     def send(self, cmd, *a, **kw):
         payload = self.protocol.encode(cmd, *a, **kw)
@@ -324,12 +552,14 @@ class TXChannel:
         else:
             _log.debug('TX: received: %s', (p,))
             self._received = p
-            if hasattr(p, 'addCredit'):
+            n = getattr(p, 'addCredit', None) or getattr(p, 'grantedCredit', None)
+            if n and (p.sidP, p.sidS) in self.link.channels:
                 c = self.link.channels[(p.sidP, p.sidS)]
-                c.credit += p.addCredit
-                _log.debug('TX: added %i credits to (%s,%s), now has %i', p.addCredit, *c.cid, c.credit)
+                self.link.credits.grant(c, n)
+                _log.debug('TX: added %i credits to (%s,%s), now has %i', n, *c.cid, c.credit)
             if p.name == 'Error':
                 _log.warning('TX: received: %s %s', p, self.protocol.ERRORS[p.errorCode])
+                self.link.pacer.record(error=True)
 
 class Channel:
 
@@ -340,55 +570,287 @@ class Channel:
         self.credit = 0
         # maxPTS, maxSTP = (0xffff, 0xffff)
         self._nctx = 0
+        self._received = collections.deque()
 
     def __enter__(self):
-        if self._nctx == 0:
-            self.link.__enter__().txn('OpenChannel', *self.cid)
-        self._nctx += 1
-        return self
+        with self.link.lock:
+            if self._nctx == 0:
+                self.link.__enter__().txn('OpenChannel', *self.cid,
+                                          **self.link.credits.request_kw('OpenChannel', self))
+            self._nctx += 1
+            return self
 
     def __exit__(self, *exc):
-        self._nctx -= 1
-        if self._nctx == 0:
-            self.link.txn('CloseChannel', *self.cid)
-            self.link.__exit__(*exc)
+        with self.link.lock:
+            self._nctx -= 1
+            if self._nctx == 0:
+                try:
+                    self.link.txn('CloseChannel', *self.cid)
+                except TimeoutError:
+                    _log.error('CloseChannel %s failed', self.name)
+                finally:
+                    self.credit = 0
+                    self.link.__exit__(*exc)
 
     def __call__(self, data):
         if not isinstance(data, bytes):
             raise Exception('D4 Channel %s: invalid data (must be bytes): %r' % (self.name, data))
-        ok = self.send(data)
-        return self.retreive()
-
-    def retreive(self, retries=6):
-        # if getattr(self, '_received', None):
-        #     _log.debug('%s: Dropping previous packet received: %s', self.name, self._received)
-        self._received = None
-        for r in range(1 + retries):
-            self.link.retreive()
+        with self.link.lock:
             if self._received:
-                return self._received
-
-    def send(self, data):
+                _log.debug('%s: Dropping previous packets received: %s', self.name, self._received)
+                self._received.clear()
+            self.link.credits.refill(self)
+            ok = self.send(data)
+            sent = time.monotonic()
+            r = self.retreive()
+            self.link.pacer.record(time.monotonic() - sent)
+            return r
+
+    def ipipeline(self, messages, window=8):
+        """Yields replies to messages, keeping up to `window` of them in flight.
+
+        Fewer are sent ahead when the peer granted less credit.
+        Replies come in sending order; None for those not received in time
+        (a lost reply shifts the later ones, which peers must match by content).
+        Only the first message of a window is paced, and only replies to
+        messages sent alone give latency samples.
+        """
+        with self.link.lock:
+            self._received.clear()
+            messages = iter(messages)
+            inflight = collections.deque() # sending times, None if sent behind others
+            more = True
+            while True:
+                while more and len(inflight) < window and (self.credit > 0 or not inflight):
+                    m = next(messages, None)
+                    if m is None:
+                        more = False
+                        continue
+                    self.link.credits.refill(self)
+                    if self.send(m, pace=not inflight):
+                        inflight.append(None if inflight else time.monotonic())
+                    else:
+                        _log.error('%s: sending failed, draining %i replies', self.name, len(inflight))
+                        more = False
+                if not inflight:
+                    return
+                try:
+                    r = self.retreive()
+                except TimeoutError:
+                    _log.warning('%s: reply lost', self.name)
+                    inflight.popleft()
+                    yield None
+                    continue
+                sent = inflight.popleft()
+                self.link.pacer.record(None if sent is None else time.monotonic() - sent)
+                yield r
+
+    def retreive(self, deadline=None):
+        "Returns the next message received. Raises TimeoutError if none comes in time."
+        if deadline is None:
+            deadline = helpers.Deadline(self.link.timeout)
+        while not self._received:
+            if deadline.expired:
+                self.link.pacer.record(error=True)
+                raise TimeoutError('%s: no reply received' % self.name)
+            self.link.retreive(deadline)
+        return self._received.popleft()
+
+    def send(self, data, pace=True):
         _log.debug('%s << %s', self.name, helpers.hexdump(data))
-        return self.link.send(data, self)
+        return self.link.send(data, self, pace=pace)
 
     def on_received(self, data, header=None):
         _log.debug('%s >> %s', self.name, data)
-        self._received = data
+        self._received.append(data)
+
+
+class Session:
+    """Keeps a link and its channels open across operations.
+
+    The D4 handshake (and the USB driver detach) then happens once. The
+    session pings the printer with a credit request when the link has been
+    unused for `keepalive` seconds (or its credit runs low), and closes after
+    `timeout` seconds of inactivity, or on `close()`, on exiting its context,
+    or at exit. A channel holding its window's worth of credit is pinged with
+    a GetSocketID instead, so credit does not pile up.
+    """
+
+    def __init__(self, link, *channels, timeout=60, keepalive=10):
+        self.link = link
+        self.channels = channels
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self._thread = None
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def open(self):
+        with self.link.lock:
+            if self.active:
+                return self
+            self._exit_stack = contextlib.ExitStack()
+            self._exit_stack.enter_context(self.link)
+            for c in self.channels:
+                self._exit_stack.enter_context(c)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='D4 session %s' % self.link.target)
+            self._thread.start()
+            atexit.register(self.close)
+            _log.info('Session opened on %s', self.link.target)
+        return self
+
+    def close(self):
+        with self.link.lock:
+            if not self.active:
+                return
+            self._stop.set()
+            t, self._thread = self._thread, None
+            atexit.unregister(self.close)
+            self._exit_stack.close()
+            _log.info('Session closed on %s', self.link.target)
+        if t is not threading.current_thread():
+            t.join()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while not self._stop.wait(min(self.keepalive, self.timeout)):
+            with self.link.lock:
+                if self._stop.is_set():
+                    return
+                last_used = self.link.last_used
+                idle = time.monotonic() - last_used
+                if idle >= self.timeout:
+                    _log.info('Session idle for %.1fs', idle)
+                    return self.close()
+                credits = self.link.credits
+                for c in self.channels:
+                    # pings double as credit refills
+                    if idle >= self.keepalive or c.credit <= credits.low:
+                        try:
+                            want = credits.want.get(c.cid, 0)
+                            if c.credit >= want:
+                                self.link.txn('GetSocketID', c.name)
+                            else: # up to a window's worth
+                                credits.request(c, grow=False, n=want - c.credit)
+                        except TimeoutError:
+                            _log.warning('Session keepalive failed on %s', c.name)
+                self.link.last_used = last_used # pings do not count as use
+
+
+class Decoder:
+    """Incremental decoder of a D4 byte stream
+
+    Packets are framed from the length in their header. Payloads on the
+    transaction channel are decoded with the revision negotiated by the last
+    Init, or else the one that last decoded.
+    """
+
+    def __init__(self, protocol=protocol_0x20):
+        self.protocol = protocol
+        self._buf = PacketBuffer()
+
+    def feed(self, b):
+        "Yields (header, payload) for each packet completed by `b`"
+        self._buf.feed(b)
+        for (header, payload) in self._buf:
+            yield header, self.decode_payload(header, payload)
+
+    def decode_payload(self, header, payload):
+        if header.cid != TXChannel.cid or not payload:
+            return payload
+        for p in (self.protocol, *REVISIONS.values()):
+            try:
+                cmd = p.decode(payload)
+            except (KeyError, IndexError, TypeError, struct.error, UnicodeDecodeError):
+                continue
+            self.protocol = p
+            if cmd.name in ('Init', 'InitReply') and cmd.revision in REVISIONS:
+                self.protocol = REVISIONS[cmd.revision]
+            return cmd
+        return payload
 
 
 def decode(packets):
     """Yields (header, payload) from iterable of `bytes`"""
-    prot = protocol_0x20
+    d = Decoder()
     for b in packets:
         header, payload = D4Link.protocol.decode(b)
-        if header.cid == TXChannel.cid:
-            for p in [prot, protocol_0x20, protocol_0x10]:
-                try:
-                    payload = p.decode(payload)
-                except:
-                    pass
-                else:
-                    prot = p
-                    break
-        yield header, payload
+        yield header, d.decode_payload(header, payload)
+
+
+def decode_stream(src, size=1 << 16):
+    """Yields (header, payload) from a raw byte stream
+
+    src -- file object, bytes-like object (bytes, mmap...), or iterable of chunks
+    """
+    d = Decoder()
+    for chunk in _ichunks(src, size):
+        yield from d.feed(chunk)
+    if len(d._buf):
+        _log.warning('Ignoring %i trailing bytes', len(d._buf))
+
+
+def _ichunks(src, size):
+    if hasattr(src, 'read'):
+        while chunk := src.read(size):
+            yield chunk
+    elif isinstance(src, (bytes, bytearray, memoryview, mmap.mmap)):
+        with memoryview(src) as m:
+            for i in range(0, len(m), size):
+                yield m[i:i+size]
+    else:
+        yield from src
+
+
+def _sample_args(cmd):
+    "Arguments for encoding `cmd` in benchmarks"
+    return [('EPSON-CTRL' if f == 'serviceName' else i + 1)
+            for (i, f) in enumerate(cmd.fields)]
+
+
+def bench(number=20000):
+    "Yields (protocol, command, encoded packets/s, decoded packets/s)"
+    import timeit
+    for prot in (protocol_0x20, protocol_0x10):
+        for (name, cmd) in prot.cmd_by_name.items():
+            a = _sample_args(cmd)
+            b = prot.encode(name, *a)
+            e = timeit.timeit(lambda: prot.encode(name, *a), number=number)
+            d = timeit.timeit(lambda: prot.decode(b), number=number)
+            yield prot.__name__, name, number / e, number / d
+    packets = [D4Link.protocol.encode(protocol_0x20.encode('CreditRequestReply', 0, 2, 2, 1)),
+               D4Link.protocol.encode(b'@BDC PS\r\nEE:010203;\x0c', 2, 2)] * (number // 2)
+    t = timeit.timeit(lambda: collections.deque(decode(packets), 0), number=1)
+    yield 'D4Link', 'decode()', None, len(packets) / t
+
+
+if __name__ == '__main__':
+    import argparse
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.d4",
+        description="IEEE 1284.4 helpers")
+    c.add_argument('--bench', action='store_true',
+                   help="Measure packets/s encoded and decoded for each command")
+    c.add_argument('--decode', metavar='FILE', type=argparse.FileType('rb'),
+                   help="Decode a raw D4 byte stream (- for stdin)")
+    args = c.parse_args()
+
+    if args.bench:
+        print('%-14s %-20s %12s %12s' % ('protocol', 'command', 'encode/s', 'decode/s'))
+        for (p, n, e, d) in bench():
+            print('%-14s %-20s %12s %12.0f' % (p, n, e and '%.0f' % e or '-', d))
+    elif args.decode:
+        with args.decode as f:
+            for (header, payload) in decode_stream(getattr(f, 'buffer', f)):
+                print(header, payload)
+    else:
+        c.print_help()
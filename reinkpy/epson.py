@@ -3,28 +3,127 @@ __all__ = (
     'EpsonDriver',
 )
 
-import collections, contextlib, dataclasses, functools, hashlib, importlib.resources, re, struct, tomllib, typing
+from . import helpers
+
+import asyncio, collections, collections.abc, contextlib, dataclasses, functools, hashlib, importlib.resources, re, struct, tomllib, typing
 import logging
 _log = logging.getLogger(__name__)
 del logging
 
 
-DB = {}
-def get_db():
-    # global DB
-    if not DB:
-        with importlib.resources.files('reinkpy').joinpath('epson.toml').open('rb') as f:
-            specs = tomllib.load(f)['EPSON']
-        for s in specs:
+class ModelDB(collections.abc.Mapping):
+    """Known models: {model name: specs}
+
+    Built from epson.toml, and cached in compiled form (marshal) until the
+    TOML changes. Specs of a group of models are shared, and each group is
+    only unmarshalled on first access.
+
+    `lookup` finds models by any of `KEYS` through precomputed indexes.
+    """
+    KEYS = ('model', 'idProduct', 'rkey', 'wkey')
+    FORMAT = 2                  # of the compiled DB
+
+    def __init__(self, groups, index, keys):
+        self._groups = groups   # [marshalled dict]
+        self.index = index      # {model: group number}
+        self.keys = keys        # {key: {value: [model]}}
+        self._cache = {}        # {group number: dict}
+        self._specs = {}        # {group number: Spec}
+
+    @classmethod
+    def load(cls):
+        import marshal, os, sys
+        b = importlib.resources.files('reinkpy').joinpath('epson.toml').read_bytes()
+        path = None
+        try:
+            path = os.path.join(helpers.cache_dir(), 'epson-%s-v%i-py%i%i.marshal' % (
+                hashlib.sha1(b).hexdigest()[:16], cls.FORMAT, *sys.version_info[:2]))
+            with open(path, 'rb') as f:
+                return cls(*marshal.loads(f.read()))
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            _log.debug('Compiling model DB (%s)', e)
+        db = cls.compile(tomllib.loads(b.decode('utf-8'))['EPSON'])
+        if path:
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    marshal.dump((db._groups, db.index, db.keys), f)
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                _log.debug('Cannot cache model DB: %s', e)
+        return db
+
+    @classmethod
+    def compile(cls, specs):
+        import marshal
+        index = {}
+        keys = dict((k, {}) for k in cls.KEYS)
+        for (i, s) in enumerate(specs):
             if 'wkey' in s:
                 s['wkey'] = s['wkey'].encode('latin-1')
             # s['brand'] = 'EPSON'
             for m in s.get('models',()):
-                DB[m] = collections.ChainMap({'model': m}, s)
+                index[m] = i
+                for (k, v) in (('model', normalize_model(m)), *((k, s.get(k)) for k in cls.KEYS[1:])):
+                    if v is not None:
+                        keys[k].setdefault(v, []).append(m)
+        return cls([marshal.dumps(s) for s in specs], index, keys)
+
+    def lookup(self, **key) -> list[str]:
+        """Models matching all of the given keys (`KEYS`, None values ignored)
+
+        `model` is matched in normalized form (see `normalize_model`).
+        """
+        res = None
+        for (k, v) in key.items():
+            if v is None:
+                continue
+            if k == 'model':
+                v = normalize_model(v)
+            m = self.keys[k].get(v, ())
+            res = m if res is None else [x for x in res if x in m]
+        return list(res or ())
+
+    def group(self, i) -> dict:
+        if i not in self._cache:
+            import marshal
+            self._cache[i] = marshal.loads(self._groups[i])
+        return self._cache[i]
+
+    def __getitem__(self, name):
+        return collections.ChainMap({'model': name}, self.group(self.index[name]))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def spec(self, name):
+        "Returns a new `Spec` for model `name`"
+        i = self.index[name]
+        if i not in self._specs:
+            self._specs[i] = Spec(**self.group(i))
+        return dataclasses.replace(self._specs[i], model=name)
+
+
+def normalize_model(name: str) -> str:
+    "Model name reduced for lookups: 'EPSON XP-352 Series' -> 'XP352'"
+    name = re.sub(r'^EPSON\s+|\s+Series$', '', name.strip(), flags=re.I)
+    return re.sub(r'[^0-9A-Z]', '', name.upper())
+
+
+DB = None
+def get_db() -> ModelDB:
+    global DB
+    if DB is None:
+        DB = ModelDB.load()
     return DB
 
 
-@dataclasses.dataclass(kw_only=True)
+@dataclasses.dataclass(kw_only=True, slots=True)
 class Spec:
     "Specification for a group of printer models"
     # USB-IF
@@ -82,26 +181,38 @@ class Epson:
         "List known models"
         return get_db().keys()
 
-    def configure(self, name: str|bool = True) -> typing.Self:
+    def configure(self, name: str|bool = True, **hints) -> typing.Self:
         """Load specs for given model name.
 
         Pass `True` to autodetect model, `False` to clear specs.
+        hints -- keys of `ModelDB.lookup` (e.g. USB product name, idProduct)
+          tried before querying the printer when autodetecting
         """
+        guessed = None
         if name is True:
-            name = self.detected_model
+            name = guessed = self._guess_model(**hints) or self.detected_model
         if name:
             if name in get_db():
-                self.spec = Spec(**get_db()[name])
+                self.spec = get_db().spec(name)
             else:
                 _log.warn(f'Unknown model name: "{name}"')
         else:
             self.spec = Spec()
-        m, d = (self.spec.model, self.detected_model)
-        if m and d and m != d:
+        m = self.spec.model
+        if m and m != guessed and (d := self.detected_model) and m != d:
             _log.warn('Loading specs for model "%s" but the printer '
                       'presents itself as "%s"', m, d)
         return self
 
+    @staticmethod
+    def _guess_model(**hints) -> str|None:
+        db = get_db()
+        for (k, v) in hints.items():
+            m = db.lookup(**{k: v})
+            if len(m) == 1:
+                _log.info('Model %s found by %s: %s', m[0], k, v)
+                return m[0]
+
     def _mem_ops(self):
         for m in self.spec.mem:
             yield self._make_reset(**m)
@@ -134,10 +245,19 @@ class Epson:
         """Send msg to the CTRL channel"""
         return tuple(self._ictrl(*msg))
 
-    def _ictrl(self, *msg: bytes | tuple['cmd', 'payload']) -> typing.Iterator[bytes]:
+    def _ictrl(self, *msg: bytes | tuple['cmd', 'payload'],
+               window: int = 1) -> typing.Iterator[bytes]:
+        """Yields replies to msg (b'' for those lost)
+
+        window -- number of messages kept in flight, if the channel can pipeline
+        """
         with self.ctrl_channel as c:
-            for m in self._iencode(*msg):
-                yield c(m)
+            if hasattr(c, 'ipipeline'):
+                for r in c.ipipeline(self._iencode(*msg), window):
+                    yield b'' if r is None else r
+            else:
+                for m in self._iencode(*msg):
+                    yield c(m)
 
     def _iencode(self, *msg: bytes | tuple['cmd', 'payload']) -> typing.Iterator[bytes]:
         for m in msg:
@@ -147,36 +267,71 @@ class Epson:
             assert isinstance(m, bytes)
             yield m
 
-    def encode(self, cmd: str | tuple[str, str], payload: bytes = b'') -> bytes:
+    def encode(self, cmd: str | tuple[str, str], payload: bytes = b'',
+               rkey: int = None) -> bytes:
         # payload = bytes(payload)
         if isinstance(cmd, tuple): # "factory command"
             c = ord(cmd[1])
-            p = struct.pack('<HBBB', self.spec.rkey, c, ~c & 0xff, (c>>1 & 0x7f) | (c<<7 & 0x80))
+            if rkey is None:
+                rkey = self.spec.rkey
+            p = struct.pack('<HBBB', rkey, c, ~c & 0xff, (c>>1 & 0x7f) | (c<<7 & 0x80))
             cmd, payload = cmd[0]*2, p + payload
         if isinstance(cmd, str):
             cmd = cmd.encode('ascii')
         # assert len(cmd) == 2
         return cmd + struct.pack('<H', len(payload)) + payload
 
-    def read_eeprom(self, *addr: int) -> list[tuple[int, int|None]]:
-        """Read addresses from EEPROM"""
+    async def actrl(self, *msg: bytes | tuple['cmd', 'payload']) -> tuple[bytes, ...]:
+        """Async `ctrl`"""
+        return tuple(await self._actrl(*msg))
+
+    async def _actrl(self, *msg: bytes | tuple['cmd', 'payload'],
+                     window: int = 1) -> list[bytes]:
+        "Returns replies to msg, running `_ictrl` in a worker thread"
+        return await asyncio.to_thread(lambda: list(self._ictrl(*msg, window=window)))
+
+    def read_eeprom(self, *addr: int, window: int = 1) -> list[tuple[int, int|None]]:
+        """Read addresses from EEPROM
+
+        window -- number of read commands kept in flight (1: one round-trip each)
+        """
+        addr, msg = self._read_msg(addr)
+        return self._read_res(addr, self._ictrl(*msg, window=window))
+
+    async def aread_eeprom(self, *addr: int, window: int = 1) -> list[tuple[int, int|None]]:
+        "Async `read_eeprom`"
+        addr, msg = self._read_msg(addr)
+        return self._read_res(addr, await self._actrl(*msg, window=window))
+
+    def _read_msg(self, addr):
         if not addr:
             addr = range(self.spec.mem_low, self.spec.mem_high+1)
         c = 'B' if self.spec.rlen == 1 else 'H'
         CMD = ('|', 'A') # (0x7c, 0x41)
-        res = []
-        for (a,r) in zip(addr, self._ictrl(*((CMD, struct.pack('<'+c, a)) for a in addr))):
+        return addr, ((CMD, struct.pack('<'+c, a)) for a in addr)
+
+    def _read_res(self, addr, replies):
+        c = 'B' if self.spec.rlen == 1 else 'H'
+        res = dict.fromkeys(addr)
+        for (a,r) in zip(addr, replies):
             try:
-                # '@BDC PS EE:ED0100;'
-                v = re.match(r'.*?\sEE:([0-9a-fA-F]{6,6});', r.decode('ascii'))
-                # values are big endian; here assuming 1-byte
-                p, val = struct.unpack('>'+c+'B', bytes.fromhex(v.group(1)))
-                assert p == a
-                res.append((a, val))
+                p, val = self._parse_ee(r, c)
             except:
                 _log.warn('Invalid response reading addr %s: %r', a, r)
-                res.append((a, None))
-        return res
+                continue
+            if p != a:
+                _log.debug('Reply for addr %s received while expecting %s', p, a)
+            if p in res:
+                res[p] = val
+        return list(res.items())
+
+    @staticmethod
+    def _parse_ee(r: bytes, c='H') -> tuple[int, int]:
+        # '@BDC PS EE:ED0100;'
+        n = 2 * struct.calcsize(c) + 2 # hex digits of address and value
+        v = re.match(r'.*?\sEE:([0-9a-fA-F]{%i});' % n, r.decode('ascii'))
+        # values are big endian; here assuming 1-byte
+        return struct.unpack('>'+c+'B', bytes.fromhex(v.group(1)))
 
     def write_eeprom(self, *addrval: tuple[int,int], wkey=None, check_read=True,
                      atomic=False) -> bool:
@@ -188,32 +343,70 @@ class Epson:
         """
         if atomic:
             prev = self.read_eeprom(*(a[0] for a in addrval))
-            _log.info('Current EEPROM values: %s', prev)
-            if not all(isinstance(v, int) for a,v in prev):
-                _log.warn('Aborting write because current values cannot be read.')
+            if not self._check_prev(prev):
+                return
+        _log.info('Writing to EEPROM: %s', addrval)
+        res = True
+        try:
+            for ((a,v),r) in zip(addrval, self._ictrl(*self._write_msg(addrval, wkey))):
+                res &= ((b':OK;' in r) and ((not check_read) or
+                                            (self.read_eeprom(a) == [(a, v)])))
+        except:                 # e.g. TimeoutError: values may be partly written
+            res = False
+            raise
+        finally:
+            if atomic and not res:
+                _log.warn('Writing failed. Trying to restore previous values')
+                self.write_eeprom(*prev, wkey=wkey, check_read=check_read, atomic=False)
+        return res
+
+    async def awrite_eeprom(self, *addrval: tuple[int,int], wkey=None, check_read=True,
+                            atomic=False) -> bool:
+        "Async `write_eeprom`"
+        if atomic:
+            prev = await self.aread_eeprom(*(a[0] for a in addrval))
+            if not self._check_prev(prev):
                 return
         _log.info('Writing to EEPROM: %s', addrval)
+        res = True
+        try:
+            for ((a,v),r) in zip(addrval, await self._actrl(*self._write_msg(addrval, wkey))):
+                res &= ((b':OK;' in r) and ((not check_read) or
+                                            (await self.aread_eeprom(a) == [(a, v)])))
+        except:                 # e.g. TimeoutError: values may be partly written
+            res = False
+            raise
+        finally:
+            if atomic and not res:
+                _log.warn('Writing failed. Trying to restore previous values')
+                await self.awrite_eeprom(*prev, wkey=wkey, check_read=check_read, atomic=False)
+        return res
+
+    @staticmethod
+    def _check_prev(prev) -> bool:
+        _log.info('Current EEPROM values: %s', prev)
+        if not all(isinstance(v, int) for a,v in prev):
+            _log.warn('Aborting write because current values cannot be read.')
+            return False
+        return True
+
+    def _write_msg(self, addrval, wkey=None):
         if wkey is None:
             wkey = self.spec.wkey
         c = 'B' if self.spec.wlen == 1 else 'H'
         CMD = ('|', 'B') # (0x7c, 0x42)
         # addresses are little endian; field values big endian (here 1-byte)
-        res = True
-        for ((a,v),r) in zip(addrval,
-                             self._ictrl(*((CMD, struct.pack('<'+c+'B', a, v) + wkey)
-                                           for (a,v) in addrval))):
-            res &= ((b':OK;' in r) and ((not check_read) or
-                                        (self.read_eeprom(a) == [(a, v)])))
-        if atomic and not res:
-            _log.warn('Writing failed. Trying to restore previous values')
-            self.write_eeprom(*prev, wkey=wkey, check_read=check_read, atomic=False)
-        return res
+        return ((CMD, struct.pack('<'+c+'B', a, v) + wkey) for (a,v) in addrval)
 
     def do_status(self):
         "Get a summary of printer state"
         return self.ctrl(('st', b'\x01'))[0] # b'@BDC ST2\r\n...'
         # To turn printer state reply on/off (Remote Mode): ST 02H 00H 00H m1
 
+    async def ado_status(self):
+        "Async `do_status`"
+        return (await self.actrl(('st', b'\x01')))[0]
+
     def do_rw(self):
         """Run generic "rw" command (for "reset waste"?)"""
         n = self.info.get('serial_number', None)
@@ -234,6 +427,14 @@ class Epson:
         _log.info('Running %s', f.__name__)
         return f()
 
+    async def areset_waste(self):
+        "Async `reset_waste`"
+        m = self.spec.get_mem('waste counter')
+        if not m:
+            _log.error('Operation unavailable')
+            return
+        return await self.awrite_eeprom(*zip(m['addr'], m['reset']), atomic=True)
+
     # "REMOTE MODE"
     # 'fl' / 'gm' # before loading firmware, in recovery mode
     # open: ('fl', b'\x01') close: ('fl', b'\x03')
@@ -252,39 +453,113 @@ class Epson:
 
     # ('Ink Information', b'\x0f\x13\x03(BBB)*', 'inkCartridgeName inkColor inkRemainCounter')
 
-    def find_rkey(self, ikeys=range(0x0,0xffff)):
-        "Find and set the 2-bytes read key / model code (brute force)"
-        orig = self.spec.rkey
-        pos = self.spec.mem_low
+    def find_rkey(self, ikeys=None, window=16, resume=True):
+        """Find and set the 2-bytes read key / model code (brute force)
+
+        ikeys -- candidates (default: all, known ones first, see `keysearch.rkey_order`)
+        window -- probes sent at once
+        resume -- continue an interrupted search for the same model
+        """
+        from .keysearch import Search, rkey_order
+        model = self.spec.model or self.detected_model
+        if ikeys is None:
+            ikeys = rkey_order(model)
+        s = Search('rkey', model, ikeys, resume=resume)
+        c = 'B' if self.spec.rlen == 1 else 'H'
+        payload = struct.pack('<'+c, self.spec.mem_low)
         with self.ctrl_channel:
-            for c in ikeys:
-                _log.info('Trying model code %04X', c)
-                self.spec.rkey = c
-                if self.read_eeprom(pos)[0][1] is not None:
-                    _log.warn('Found model code: %04X', c)
-                    return c
-            else:
-                self.spec.rkey = orig
+            for batch in s.ibatches(window):
+                replies = list(self._ictrl(
+                    *(self.encode(('|', 'A'), payload, rkey=k) for k in batch), window=window))
+                i = next((i for (i, r) in enumerate(replies) if self._reads(r, c)), None)
+                if i is None and b'' in replies:
+                    i = 0       # the reply lost may be the key's
+                if i is None:
+                    continue
+                # after a lost reply, later ones come early: confirm one by one
+                for k in batch[i:]:
+                    for _ in range(3): # again while replies are lost
+                        if r := self.ctrl(self.encode(('|', 'A'), payload, rkey=k))[0]:
+                            break
+                    if self._reads(r, c):
+                        s.found('%04X' % k)
+                        self.spec.rkey = k
+                        return k
+
+    @classmethod
+    def _reads(cls, r: bytes, c='H') -> bool:
+        "Whether r is a valid EEPROM read reply"
+        try:
+            cls._parse_ee(r, c)
+        except:
+            return False
+        return True
+
+    def find_wkey(self, ikeys=None, addr=None, wordlists=(), window=16, resume=True):
+        """Find and set the 8-bytes write key (brute force)
+
+        Each key is tried by writing to `addr`; only accepted writes are
+        read back, then undone.
 
-    def find_wkey(self, ikeys=(b'',), addr=None):
-        "Try each key in ikeys iterable to write to addr"
+        ikeys -- candidates (default: known keys and their Caesar shifts,
+          then `wordlists`, see `keysearch.wkey_order`)
+        wordlists -- key files, streamed (see `wordlist`)
+        window -- writes sent at once
+        resume -- continue an interrupted search for the same model and wordlists
+        """
+        from .keysearch import Search, wkey_order, wkey_order_id
+        from .wordlist import unique
         if addr is None:
             addr = self.spec.mem_low
-        val = self.read_eeprom(addr)[0][1]
-        newval = val + 1
-        # TODO: DB
+        for _ in range(3):      # again while replies are lost
+            if (val := self.read_eeprom(addr)[0][1]) is not None:
+                break
+        else:
+            _log.error('Cannot read address %s: wrong rkey?', addr)
+            return
+        newval = (val + 1) & 0xff
+        model = self.spec.model or self.detected_model
         if ikeys is None:
-            DB = get_db()
-            ikeys = set(s.get('wkey', b'') for s in DB.values())
+            s = Search('wkey', model, wkey_order(model, wordlists),
+                       wkey_order_id(model, wordlists), resume)
+        else:
+            s = Search('wkey', model, list(unique(ikeys)), resume=resume)
         with self.ctrl_channel:
-            for k in ikeys:
-                _log.info('Trying key %s', k)
-                if self.write_eeprom((addr, newval), wkey=k, check_read=True):
-                    _log.warn('>>>    !!! FOUND KEY !!!   %r   <<<', k)
-                    print(k)
-                    self.write_eeprom((addr, val), wkey=k)
-                    self.spec.wkey = k
-                    return k
+            for batch in s.ibatches(window):
+                replies = list(self._ictrl(
+                    *(self.encode(*m) for k in batch for m in self._write_msg([(addr, newval)], k)),
+                    window=window))
+                i = next((i for (i, r) in enumerate(replies) if b':OK;' in r), None)
+                if i is None and b'' in replies and self.read_eeprom(addr) == [(addr, newval)]:
+                    i = 0       # the reply lost was the key's
+                if i is None:
+                    continue
+                # after a lost reply, later ones come early: confirm one by
+                # one, undoing the write
+                for k in batch[i:]:
+                    if self._restore_with(addr, val, k):
+                        s.found(k)
+                        self.spec.wkey = k
+                        return k
+                _log.warning('Write accepted, but by no key of the batch: '
+                             'address %s may hold %s', addr, newval)
+
+    def _restore_with(self, addr, val, wkey, tries=3) -> bool:
+        "Whether wkey writes `val` back to `addr`, tried again while replies are lost"
+        ok = False
+        try:
+            for _ in range(tries):
+                if ok := self.write_eeprom((addr, val), wkey=wkey, check_read=False):
+                    return ok
+            return ok
+        finally:
+            if ok:              # make sure `val` is there, whatever reply gets lost
+                for _ in range(tries):
+                    if self.read_eeprom(addr) == [(addr, val)] or \
+                       self.write_eeprom((addr, val), wkey=wkey):
+                        break
+                else:
+                    _log.error('Restoring address %s to %s failed', addr, val)
 
 
 class EpsonD4(Epson):
@@ -305,6 +580,10 @@ class EpsonD4(Epson):
 
     @functools.cached_property
     def info(self) -> dict:
+        return self.read_info()
+
+    def read_info(self) -> dict:
+        "Reads the printer ID (`info` uncached)"
         try:
             r = self._read_id_string()
             from . import _parse_ieee1284_id
@@ -316,16 +595,38 @@ class EpsonD4(Epson):
 
 class EpsonSNMP(Epson):
 
+    reply_size = 32             # expected size of a reply, for packing GETs
+
     def _init_link(self):
         self.link.OID_EPSON = self.link.OID_ENTERPRISE + '.1248'
         self.link.OID_CTRL = self.link.OID_EPSON + '.1.2.2.44.1.1.2.1'
         self.ctrl_channel = contextlib.nullcontext(self._ctrl_send)
 
-    def _ctrl_send(self, m):
+    def _ctrl_oid(self, m):
         # *struct.unpack('B'*len(payload), payload)
-        res = self.link.get('.'.join((self.link.OID_CTRL, *(str(b) for b in m))))
+        return '.'.join((self.link.OID_CTRL, *(str(b) for b in m)))
+
+    def _ctrl_send(self, m):
+        res = self.link.get(self._ctrl_oid(m))
         #
-        return res[0][1].asOctets()
+        return res[0][1]
+
+    def _ictrl(self, *msg: bytes | tuple['cmd', 'payload'],
+               window: int = 1) -> typing.Iterator[bytes]:
+        """Yields replies to msg
+
+        Commands are sent as var-binds of as few GETs as fit the link's
+        `max_size`; window is ignored.
+        """
+        for v in self.link.iget(map(self._ctrl_oid, self._iencode(*msg)),
+                                self.reply_size):
+            yield b'' if v is None else v
+
+    async def _actrl(self, *msg: bytes | tuple['cmd', 'payload'],
+                     window: int = 1) -> list[bytes]:
+        return [b'' if v is None else v async for v in
+                self.link.aiget(map(self._ctrl_oid, self._iencode(*msg)),
+                                self.reply_size)]
 
     # @functools.cached_property
     @property
@@ -334,27 +635,212 @@ class EpsonSNMP(Epson):
 
 
 
+# re.S: length and rkey are binary, and may hold b'\n' (e.g. rkey 0x0a01)
+_OP_PAT = re.compile(br'\|\|(?P<length>..)(?P<rkey>..)(?P<cmd>A\xbe\xa0|B\xbd!)', re.S)
+_RAW_PAT = re.compile(b'([\x20-\x7E]{8})') # any 8-chars strings
+_NONRAW_PAT = re.compile(b'[^\x20-\x7E]')
+
+
 def search_bin(bstr=b'', yield_raw=True):
     """Yields read/write operations found in bytes"""
-    pat = br'\|\|(?P<length>..)(?P<rkey>..)(?P<cmd>A\xbe\xa0|B\xbd!)'
-    for m in re.finditer(pat, bstr):
+    for (pos, res) in _isearch_ops(bstr):
+        yield res
+    if yield_raw:
+        for (pos, res) in _isearch_raw(bstr):
+            yield res
+
+
+def _iparse_ops(buf, start=0, stop=None):
+    """Yields (offset, op) of operations starting in buf[start:stop]
+
+    op -- ('READ', rkey, addr) or ('WRITE', rkey, addr, val, wkey); None if invalid
+    """
+    stop = len(buf) if stop is None else stop
+    for m in _OP_PAT.finditer(buf, start, min(len(buf), stop + 9)):
+        if m.start() >= stop:
+            break
         try:
-            end = m.span()[1]
-            payload = bstr[end:end + struct.unpack('<H', m.group('length'))[0] - 5]
+            end = m.end()
+            payload = buf[end:end + struct.unpack('<H', m.group('length'))[0] - 5]
             rkey = struct.unpack('<H', m.group('rkey'))[0]
             if m.group('cmd')[0] == 0x41:
-                addr = struct.unpack('<H', payload[:2])[0]
-                yield f'rkey:{rkey:04x} READ addr:{addr:04x}'
+                yield m.start(), ('READ', rkey, struct.unpack('<H', payload[:2])[0])
             else:
                 a,v = struct.unpack('<HB', payload[:3])
-                yield f'rkey:{rkey:04x} WRITE addr:{a:04x} val:{v:02x} wkey:{payload[3:]}'
+                yield m.start(), ('WRITE', rkey, a, v, bytes(payload[3:]))
         except:
-            _log.exception()
-            yield 'INVALID %r' % m.group()
-    if yield_raw: # any 8-chars strings
-        for m in re.finditer(b'([\x20-\x7E]{8})', bstr):
-            yield m.group().decode('ascii')
+            _log.exception('Invalid operation at %i', m.start())
+            yield m.start(), None
+
+
+def _isearch_ops(buf, start=0, stop=None):
+    "Yields (offset, description) of operations starting in buf[start:stop]"
+    for (pos, op) in _iparse_ops(buf, start, stop):
+        if op is None:
+            yield pos, 'INVALID %r' % _OP_PAT.match(buf, pos).group()
+        elif op[0] == 'READ':
+            yield pos, 'rkey:%04x READ addr:%04x' % op[1:]
+        else:
+            yield pos, 'rkey:%04x WRITE addr:%04x val:%02x wkey:%s' % op[1:]
+
+
+def _isearch_raw(buf, start=0, stop=None):
+    "Yields (offset, string) of 8-chars strings starting in buf[start:stop]"
+    stop = len(buf) if stop is None else stop
+    # start matching where the printable run containing `start` begins, so
+    # that matches line up as in a search of the whole buffer
+    run = start
+    while run > 0:
+        m = None
+        for m in _NONRAW_PAT.finditer(buf, max(0, run - 4096), run):
+            pass
+        if m:
+            run = m.end()
+            break
+        run = max(0, run - 4096)
+    for m in _RAW_PAT.finditer(buf, run, min(len(buf), stop + 8)):
+        if m.start() >= stop:
+            break
+        if m.start() >= start:
+            yield m.start(), m.group().decode('ascii')
+
+
+_mmap = None
+def _init_search(path):
+    global _mmap
+    import mmap
+    with open(path, 'rb') as f:
+        _mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _search_chunk(start, stop, yield_raw):
+    res = list(_isearch_ops(_mmap, start, stop))
+    if yield_raw:
+        res += _isearch_raw(_mmap, start, stop)
+    return [r for (pos, r) in sorted(res)]
+
+
+def _imap_chunks(path, f, *args, chunk_size=1 << 24, jobs=None, align=1):
+    """Yields f(start, stop, *args) for chunks of a file, in order
+
+    Chunks are run by `jobs` processes, the file being memory-mapped in
+    each (as `_mmap`). Chunk sizes are multiples of `align`.
+    """
+    global _mmap
+    import os
+    size = os.path.getsize(path)
+    jobs = jobs or os.cpu_count()
+    chunk_size -= chunk_size % align
+    chunks = [(i, min(size, i + chunk_size), *args) for i in range(0, size, chunk_size)]
+    if len(chunks) <= 1 or jobs == 1:
+        if size:
+            _init_search(path)
+            try:
+                for c in chunks:
+                    yield f(*c)
+            finally:
+                _mmap.close()
+                _mmap = None
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs, initializer=_init_search, initargs=(path,)) as ex:
+        pending = collections.deque()
+        for c in chunks:
+            pending.append(ex.submit(f, *c))
+            if len(pending) > 2 * jobs: # bound results held in memory
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def search_file(path, yield_raw=True, chunk_size=1 << 24, jobs=None):
+    """Yields read/write operations (and 8-chars strings) found in a file
+
+    The file is memory-mapped and searched in chunks by `jobs` processes.
+    Results come in file order, each match once.
+    """
+    for res in _imap_chunks(path, _search_chunk, yield_raw, chunk_size=chunk_size, jobs=jobs):
+        yield from res
+
+
+def _count_writes(start, stop):
+    return collections.Counter(op[1:] for (pos, op) in _iparse_ops(_mmap, start, stop)
+                               if op and op[0] == 'WRITE')
+
+
+def _match_keys(start, stop, pat, width):
+    "Keys of pat found as whole entries of a key file chunk (lines, or `width`-aligned)"
+    res = collections.Counter()
+    for m in pat.finditer(_mmap, start, min(len(_mmap), stop + 64)):
+        i, j = m.span()
+        if i >= stop:
+            break
+        if width:
+            ok = not i % width
+        else:
+            ok = (i == 0 or _mmap[i-1] in b'\r\n') and (j == len(_mmap) or _mmap[j] in b'\r\n')
+        if ok:
+            res[m.group()] += 1
+    return res
+
+
+class WriteIndex:
+    """EEPROM writes found in captured vendor traffic, indexed by rkey
+
+    Write commands carry their wkey in clear: candidate keys can be
+    checked against captures offline (`check`), leaving the printer for
+    the few that match.
+    """
 
+    def __init__(self):
+        self.writes = {}        # {rkey: Counter({(addr, val, wkey): count})}
+
+    def add(self, path, jobs=None):
+        "Index the writes of a capture (or any binary file)"
+        for c in _imap_chunks(path, _count_writes, jobs=jobs):
+            for ((rkey, a, v, wkey), n) in c.items():
+                self.writes.setdefault(rkey, collections.Counter())[(a, v, wkey)] += n
+        return self
+
+    def wkeys(self, rkey=None) -> collections.Counter:
+        "{wkey: count} of writes (with rkey, or all)"
+        res = collections.Counter()
+        for (r, c) in self.writes.items():
+            if rkey is None or r == rkey:
+                for ((a, v, wkey), n) in c.items():
+                    res[wkey] += n
+        return res
+
+    def addrs(self, rkey) -> collections.Counter:
+        "{addr: count} of writes with rkey"
+        res = collections.Counter()
+        for ((a, v, wkey), n) in self.writes.get(rkey, {}).items():
+            res[a] += n
+        return res
+
+    def ranked(self) -> list[tuple[int, bytes, int]]:
+        "(rkey, wkey, count) of writes, most frequent first"
+        return sorted(((r, k, n) for r in self.writes for (k, n) in self.wkeys(r).items()),
+                      key=lambda x: -x[2])
+
+    def check(self, *wordlists, rkey=None, jobs=None, size=8) -> list[bytes]:
+        """Keys of wordlists (see `wordlist`) seen in writes, most frequent first
+
+        rkey -- only writes with this rkey
+        size -- of keys, as in `wordlist.iread`; other captured keys are ignored
+        Files are scanned in parallel chunks.
+        """
+        import os
+        seen = collections.Counter(dict((k, n) for (k, n) in self.wkeys(rkey).items()
+                                        if len(k) == size))
+        if not seen:
+            return []
+        pat = re.compile(b'|'.join(map(re.escape, sorted(seen))))
+        found = set()
+        for p in wordlists:
+            width = size if os.fspath(p).endswith('.bin') else 0
+            for c in _imap_chunks(p, _match_keys, pat, width, jobs=jobs, align=width or 1):
+                found.update(c)
+        return sorted(found, key=lambda k: -seen[k])
 
 if __name__ == '__main__':
     import argparse
@@ -362,15 +848,34 @@ if __name__ == '__main__':
         prog="python -m reinkpy.epson",
         description="Helpers for Epson printers",
         epilog="")
-    c.add_argument('--search-file', type=argparse.FileType('rb'),
+    c.add_argument('--search-file', metavar='FILE',
                    help="""Search a traffic log file (like pcapng)
                    for read/write operations and (if extension is not .pcapng)
                    an "adjustment program" binary for potential keys.""")
+    c.add_argument('--index', metavar='FILE', nargs='+',
+                   help="Index the EEPROM writes of captures, listing their keys")
+    c.add_argument('--check', metavar='WORDLIST', nargs='+', default=(),
+                   help="With --index: keys of wordlists seen in the captured writes")
+    c.add_argument('--rkey', type=lambda x: int(x, 16), help="With --index: of this rkey (hex)")
+    c.add_argument('--jobs', type=int, default=None,
+                   help="Number of processes searching (default: number of CPUs)")
     args = c.parse_args()
 
     if args.search_file is not None:
-        for res in search_bin(args.search_file.read(),
-                              yield_raw=not args.search_file.name.endswith('.pcapng')):
+        for res in search_file(args.search_file, jobs=args.jobs,
+                               yield_raw=not args.search_file.endswith('.pcapng')):
             print(res)
+    elif args.index:
+        idx = WriteIndex()
+        for p in args.index:
+            idx.add(p, args.jobs)
+        if args.check:
+            for k in idx.check(*args.check, rkey=args.rkey, jobs=args.jobs):
+                print(k)
+        else:
+            for (r, k, n) in idx.ranked():
+                if args.rkey is None or r == args.rkey:
+                    addrs = ' '.join('%04x' % a for a in sorted(idx.addrs(r)))
+                    print(f'rkey:{r:04x}\twkey:{k}\t{n} writes\taddr: {addrs}')
     else:
         c.print_help()
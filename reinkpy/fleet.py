@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Running operations on many network printers concurrently"""
+__all__ = (
+    'ACTIONS',
+    'arun',
+)
+
+from . import NetworkDevice
+from .snmp import SNMPLink
+import asyncio, inspect
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+ACTIONS = {
+    'info': lambda d: dict(d.info),
+    'status': lambda d: d.epson.ado_status(),
+    'read_eeprom': lambda d: d.epson.aread_eeprom(),
+    'reset_waste': lambda d: d.epson.areset_waste(),
+}
+
+
+async def _run_one(ip, action, sem, link_kw):
+    async with sem:
+        link = SNMPLink(ip, **link_kw)
+        d = NetworkDevice(ip, snmp=link)
+        try:
+            await link.ainfo()  # cached: configuring specs needs no more I/O
+            res = ACTIONS[action](d)
+            if inspect.isawaitable(res):
+                res = await res
+            return d, res
+        except Exception as e:
+            _log.debug('%s: %s failed', ip, action, exc_info=True)
+            return d, e
+        finally:
+            link.close()
+
+
+async def arun(ips, action='info', limit=32, **link_kw):
+    """Yields (device, result or exception) as each device is done
+
+    action -- key of `ACTIONS`
+    limit -- maximum number of devices handled at once
+    link_kw -- `SNMPLink` arguments (port, version, user)
+    """
+    sem = asyncio.Semaphore(limit)
+    tasks = [asyncio.ensure_future(_run_one(ip, action, sem, link_kw)) for ip in ips]
+    try:
+        for t in asyncio.as_completed(tasks):
+            yield await t
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+if __name__ == '__main__':
+    import argparse, time
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.fleet",
+        description="Run an operation on many network printers concurrently")
+    c.add_argument('ip', nargs='+')
+    c.add_argument('--action', choices=ACTIONS, default='info')
+    c.add_argument('--jobs', type=int, default=32, help="Devices handled at once")
+    c.add_argument('--port', type=int, default=161)
+    args = c.parse_args()
+
+    async def main():
+        t = time.monotonic()
+        n = 0
+        async for (d, res) in arun(args.ip, args.action, args.jobs, port=args.port):
+            n += 1
+            print(f'{d.ip}\t{d.name}\t{res!r}', flush=True)
+        _log.info('%i devices in %.2f s', n, time.monotonic() - t)
+
+    asyncio.run(main())
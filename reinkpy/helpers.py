@@ -1,8 +1,11 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 from codecs import charmap_decode
 # from binascii import hexlify
+import os, time
 
 __all__ = (
+    'Deadline',
+    'cache_dir',
     'hexdump',
 )
 
@@ -30,3 +33,26 @@ def hexdump(b, *, W=32, table=TABLE, prefix='\n'):
             yield ('%-{}s'.format(3*W)) % '  '.join(a)
             # yield '%-48s  |%-16s|' % (h, a)
     return prefix + prefix.join(gen())
+
+
+class Deadline:
+    "Point in time `timeout` seconds from now (never if None)"
+
+    def __init__(self, timeout=None):
+        self.end = None if timeout is None else time.monotonic() + timeout
+
+    def remaining(self):
+        return None if self.end is None else max(0.0, self.end - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+
+def cache_dir():
+    "Per-user cache directory of reinkpy (created if needed)"
+    base = (os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+            or os.path.join(os.path.expanduser('~'), '.cache'))
+    d = os.path.join(base, 'reinkpy')
+    os.makedirs(d, exist_ok=True)
+    return d
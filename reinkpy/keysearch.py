@@ -0,0 +1,134 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Brute-force key searches: candidate ordering, progress and checkpoints
+
+A `Search` hands out candidates in batches, logs tries per second and
+saves its position, so that an interrupted search resumes where it left.
+"""
+__all__ = (
+    'Search',
+    'rkey_order',
+    'wkey_order',
+)
+
+from . import helpers
+import functools, hashlib, itertools, math, os, time
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+def _known_order(keys: dict, model=None) -> list:
+    "Keys of a `ModelDB.keys` index, by closeness of their models to `model`, then use"
+    from .epson import normalize_model
+    target = normalize_model(model) if model else ''
+    def rank(item):
+        k, models = item
+        close = max(len(os.path.commonprefix((target, normalize_model(m)))) for m in models)
+        return (-close, -len(models), k)
+    return [k for (k, _) in sorted(keys.items(), key=rank)]
+
+
+def rkey_order(model: str = None, db=None) -> list[int]:
+    """All 2-byte read keys, known ones first
+
+    Keys of the model DB come by closeness of their models' names to
+    `model` (same family first), then by how many models use them.
+    """
+    from .epson import get_db
+    known = _known_order((db or get_db()).keys['rkey'], model)
+    return known + sorted(set(range(0x10000)).difference(known))
+
+
+def wkey_order(model: str = None, wordlists=(), db=None, shifts=(1, -1, 2, -2, 3, -3)):
+    """Yields candidate write keys, each once, most likely first
+
+    Keys of the model DB (ordered as in `rkey_order`), then their Caesar
+    shifts (`wkey1` being one), then the keys of `wordlists` files.
+    """
+    from .epson import get_db
+    from .wordlist import caesar, iread, unique
+    known = _known_order((db or get_db()).keys['wkey'], model)
+    shifted = (caesar(k, s) for s in shifts for k in known)
+    files = (k for p in wordlists for k in iread(p))
+    return unique(k for k in itertools.chain(known, shifted, files) if k)
+
+
+def wkey_order_id(model=None, wordlists=()) -> str:
+    "Identifies the order of `wkey_order` (model DB, and wordlists as they are on disk)"
+    from .epson import get_db
+    h = hashlib.sha1(repr((model, sorted(get_db().keys['wkey']))).encode())
+    for p in wordlists:
+        st = os.stat(p)
+        h.update(repr((os.path.abspath(p), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()[:16]
+
+
+class Search:
+    """Candidates handed out in batches, with tries/s reports and checkpoints
+
+    kind, target -- identify the search, e.g. ('rkey', 'XP-352')
+    candidates -- iterable, in the same order on each run
+    order -- identifies that order (default: digest of `candidates`, then
+      held in a list)
+    resume -- start after the last checkpoint of the same search and order
+    """
+    interval = 5.0              # s between checkpoints and reports
+
+    def __init__(self, kind, target, candidates, order=None, resume=True):
+        self.key = f'{kind}:{target}'
+        if order is None:
+            candidates = list(candidates) # may be an iterator: consumed once
+            order = hashlib.sha1(repr(candidates).encode()).hexdigest()[:16]
+        self.candidates = candidates
+        self.order = order
+        e = self._checkpoints.get(self.key) if resume else None
+        self.start = e['next'] if e and e.get('order') == order else 0
+        self.tried = 0
+        self.done = False
+
+    @functools.cached_property
+    def _checkpoints(self):
+        from .cache import Cache
+        c = Cache(os.path.join(helpers.cache_dir(), 'keysearch.json'))
+        c.ttl = math.inf        # searches may last longer than device IDs
+        return c
+
+    def ibatches(self, size: int):
+        "Yields lists of up to `size` candidates, checkpointing after each one is done"
+        if self.start:
+            _log.info('Resuming %s search at candidate %i', self.key, self.start)
+        it = iter(self.candidates)
+        if self.start:
+            it = itertools.islice(it, self.start, None)
+        t0 = t = time.monotonic()
+        n = 0
+        try:
+            while batch := list(itertools.islice(it, size)):
+                yield batch
+                self.tried += len(batch)
+                if (now := time.monotonic()) - t >= self.interval:
+                    _log.info('%s: %i tried, %.1f/s', self.key, self.start + self.tried,
+                              (self.tried - n) / (now - t))
+                    self.checkpoint()
+                    t, n = now, self.tried
+            if self.tried:
+                _log.info('%s: %i tried in %.1f s', self.key, self.tried,
+                          time.monotonic() - t0)
+            elif self.start:
+                _log.warning('%s: no candidates left after checkpoint %i', self.key, self.start)
+            self.done = True    # exhausted: the next run starts over
+            self._checkpoints.discard(self.key)
+            self._checkpoints.flush()
+        finally:
+            if not self.done:
+                self.checkpoint()
+
+    def checkpoint(self):
+        self._checkpoints.put(self.key, order=self.order, next=self.start + self.tried)
+        self._checkpoints.flush()
+
+    def found(self, key):
+        _log.warn('%s found: %r', self.key, key)
+        self.done = True
+        self._checkpoints.discard(self.key)
+        self._checkpoints.flush()
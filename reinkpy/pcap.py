@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Reading USB traffic captures (pcapng or pcap files, usbmon or USBPcap)"""
+__all__ = (
+    'iter_packets',
+    'iter_transfers',
+    'iter_records',
+    'latency_stats',
+)
+
+from . import d4
+
+import collections, statistics, struct
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+XFER_BULK = 3
+
+Transfer = collections.namedtuple('Transfer', 'time device endpoint direction data')
+Record = collections.namedtuple('Record', 'time device direction header payload')
+
+
+def iter_packets(f):
+    "Yields (linktype, time, data) from a pcapng or pcap file object"
+    magic = f.read(4)
+    if magic == b'\x0a\x0d\x0d\x0a':
+        yield from _iter_pcapng(f, magic)
+    elif magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1',
+                   b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        yield from _iter_pcap(f, magic)
+    else:
+        raise ValueError('Not a pcap or pcapng file (magic: %r)' % magic)
+
+
+def _iter_pcap(f, magic):
+    bo = '<' if magic[0] in (0xd4, 0x4d) else '>'
+    tsres = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+    linktype = struct.unpack(bo + 'HHiIII', f.read(20))[-1]
+    rec = struct.Struct(bo + 'IIII')
+    while len(h := f.read(rec.size)) == rec.size:
+        sec, frac, caplen, origlen = rec.unpack(h)
+        yield linktype, sec + frac * tsres, f.read(caplen)
+
+
+def _iter_pcapng(f, magic):
+    bo = '<'
+    ifaces = []                 # (linktype, tsres)
+    while len(h := magic or f.read(4)) == 4:
+        magic = None
+        if h == b'\x0a\x0d\x0d\x0a': # section header: resets byte order and interfaces
+            n = f.read(4)
+            bom = f.read(4)
+            bo = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            length = struct.unpack(bo + 'I', n)[0]
+            f.read(length - 12)
+            ifaces = []
+            continue
+        btype, length = struct.unpack(bo + 'II', h + f.read(4))
+        body = f.read(length - 12)
+        f.read(4)
+        if btype == 1:          # interface description
+            ifaces.append((struct.unpack_from(bo + 'H', body)[0],
+                           _tsresol(_options(body[8:], bo).get(9))))
+        elif btype in (6, 2):   # enhanced / obsolete packet
+            if btype == 6:
+                iid, hi, lo, caplen = struct.unpack_from(bo + 'IIII', body)
+            else:
+                iid, drops, hi, lo, caplen = struct.unpack_from(bo + 'HHIII', body)
+            linktype, tsres = ifaces[iid]
+            yield linktype, ((hi << 32) | lo) * tsres, body[20:20 + caplen]
+        elif btype == 3:        # simple packet
+            origlen = struct.unpack_from(bo + 'I', body)[0]
+            yield ifaces[0][0], None, body[4:4 + origlen]
+
+
+def _options(b, bo):
+    res = {}
+    i = 0
+    while i + 4 <= len(b):
+        code, length = struct.unpack_from(bo + 'HH', b, i)
+        if code == 0:
+            break
+        res[code] = b[i+4:i+4+length]
+        i += 4 + (length + 3) // 4 * 4
+    return res
+
+
+def _tsresol(b):
+    if not b:
+        return 1e-6
+    v = b[0]
+    return 2.0 ** -(v & 0x7f) if v & 0x80 else 10.0 ** -v
+
+
+# usbmon: id, type, xfer_type, epnum, devnum, busnum, flag_setup, flag_data,
+# ts_sec, ts_usec, status, length, len_cap, setup
+_USBMON = struct.Struct('<QcBBBHcc q i i I I 8x')
+# USBPcap: headerLen, irpId, status, function, info, bus, device, endpoint,
+# transfer, dataLength
+_USBPCAP = struct.Struct('<HQIHBHHBBI')
+
+
+def iter_transfers(packets):
+    """Yields bulk `Transfer`s with data from (linktype, time, data)
+
+    direction is 'out' (host to device) or 'in'.
+    """
+    for (linktype, t, b) in packets:
+        if linktype in (LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED):
+            if len(b) < _USBMON.size:
+                continue
+            (_, ev, xfer, ep, dev, bus, _, _, sec, usec, status, length,
+             caplen) = _USBMON.unpack_from(b)
+            hlen = 48 if linktype == LINKTYPE_USB_LINUX else 64
+            done = ev == b'C'
+            device = '%i.%i' % (bus, dev)
+            if t is None:
+                t = sec + usec * 1e-6
+            data = b[hlen:hlen + caplen]
+        elif linktype == LINKTYPE_USBPCAP:
+            if len(b) < _USBPCAP.size:
+                continue
+            (hlen, _, status, _, info, bus, dev, ep, xfer,
+             length) = _USBPCAP.unpack_from(b)
+            done = bool(info & 1)
+            device = '%i.%i' % (bus, dev)
+            data = b[hlen:hlen + length]
+        else:
+            continue
+        if xfer != XFER_BULK or not data:
+            continue
+        # OUT data goes with the submission, IN data with the completion
+        if ep & 0x80 and done:
+            yield Transfer(t, device, ep, 'in', data)
+        elif not ep & 0x80 and not done:
+            yield Transfer(t, device, ep, 'out', data)
+
+
+def iter_records(transfers):
+    """Yields `Record`s of D4 packets from bulk transfers
+
+    Packets spanning several transfers are reassembled, per device and
+    direction; direction is 'write' (host to printer) or 'read'.
+    """
+    decoders = {}
+    for tr in transfers:
+        k = (tr.device, tr.direction)
+        if k not in decoders:
+            decoders[k] = d4.Decoder()
+        for (header, payload) in decoders[k].feed(tr.data):
+            yield Record(tr.time, tr.device, 'write' if tr.direction == 'out' else 'read',
+                         header, payload)
+
+
+def _kind(payload):
+    "Name of a command, as used in latency stats"
+    if isinstance(payload, d4.Packet):
+        return payload.name
+    if payload[:2] == b'||' and len(payload) > 6:
+        return '||' + chr(payload[6])
+    return payload[:2].decode('latin-1')
+
+
+def latency_stats(records):
+    """Returns {command: (count, min, median, mean, max)} of reply latencies (s)
+
+    Writes are paired in order with the following reads on the same device
+    and channel (on the transaction channel, with the matching reply).
+    """
+    pending = collections.defaultdict(collections.deque) # (device, cid): [(time, kind)]
+    lat = collections.defaultdict(list)
+    for r in records:
+        if r.time is None or not r.payload:
+            continue
+        q = pending[(r.device, r.header.cid)]
+        if r.direction == 'write':
+            q.append((r.time, _kind(r.payload)))
+            continue
+        for (i, (t, kind)) in enumerate(q):
+            if not isinstance(r.payload, d4.Packet) or r.payload.name == kind + 'Reply':
+                del q[i]
+                lat[kind].append(r.time - t)
+                break
+    return dict((k, (len(v), min(v), statistics.median(v), statistics.fmean(v), max(v)))
+                for (k, v) in sorted(lat.items()))
+
+
+if __name__ == '__main__':
+    import argparse
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.pcap",
+        description="Decode D4 traffic from a USB capture (usbmon or USBPcap)")
+    c.add_argument('file', type=argparse.FileType('rb'))
+    c.add_argument('--stats', action='store_true',
+                   help="Print reply latencies per command instead of records")
+    args = c.parse_args()
+
+    with args.file as f:
+        records = iter_records(iter_transfers(iter_packets(f)))
+        if args.stats:
+            print('%-20s %6s %10s %10s %10s %10s' % ('command', 'count', 'min', 'median', 'mean', 'max'))
+            for (k, v) in latency_stats(records).items():
+                print('%-20s %6i %10.6f %10.6f %10.6f %10.6f' % (k, *v))
+        else:
+            from .epson import search_bin
+            for r in records:
+                p = r.payload
+                if isinstance(p, bytes) and p[:2] == b'||':
+                    p = ' '.join(search_bin(p, yield_raw=False)) or p
+                print('%.6f %s %-5s %s %s' % (r.time or 0, r.device, r.direction, r.header.cid, p))
@@ -0,0 +1,252 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Simulated printer, for testing and benchmarking without hardware
+
+`SimPrinter` has the interface of `FileIO` / `UsbIO` and answers like an
+Epson printer over IEEE 1284.4: the EJL switch to D4 mode, transactions
+of protocol revision 0x20 or 0x10, and on the control channel the `di`,
+`st` and EEPROM read/write (`||A`, `||B`) commands, with the read and
+write keys of a model of the DB. Replies are delayed by `latency` plus
+up to `jitter` seconds, and dropped with probability `loss`.
+
+    d = UsbDevice(SimPrinter('XP-352', latency=0.002))
+    d.epson.read_eeprom(window=8)
+"""
+__all__ = (
+    'SimPrinter',
+    'bench',
+)
+
+from . import d4
+import heapq, random, struct, threading, time
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+ENTER_D4 = b'@EJL 1284.4'
+ENTER_D4_REPLY = b'\x00\x00\x00\x08\x01\x00\xc5\x00'
+SERVICES = {'EPSON-CTRL': 0x02, 'EPSON-DATA': 0x40}
+
+
+class SimPrinter:
+
+    max_packet = 512            # bytes returned by one read, as a USB bulk endpoint
+
+    def __init__(self, model='XP-352', mem=None, *, rkey=None, wkey=None,
+                 revision=0x20, credit=8, latency=0.0, jitter=0.0, loss=0.0,
+                 serial_number='SIM0001', seed=None):
+        """
+        mem -- {addr: value} of the EEPROM (default: all 0 in the model's range)
+        rkey, wkey -- keys accepted (default: the model's; no wkey: any)
+        revision -- of the transaction protocol, the only one accepted
+        credit -- granted per credit request
+        """
+        from .epson import get_db
+        spec = get_db().spec(model)
+        self.model = model
+        self.spec = spec
+        self.rkey = spec.rkey if rkey is None else rkey
+        self.wkey = spec.wkey if wkey is None else wkey
+        self.mem = dict.fromkeys(range(spec.mem_low, spec.mem_high + 1), 0)
+        self.mem.update(mem or {})
+        self.revision = revision
+        self.credit = credit
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.serial_number = serial_number
+        self.info = {'manufacturer': 'EPSON', 'product': f'{model} Series',
+                     'serial_number': serial_number, 'idVendor': spec.idVendor,
+                     'idProduct': spec.idProduct}
+        self.id_string = (f'MFG:EPSON;CMD:ESCPL2,BDC,D4;MDL:{model} Series;'
+                          f'CLS:PRINTER;DES:EPSON {model} Series;')
+        self.stats = dict.fromkeys(('writes', 'replies', 'lost', 'reads', 'eeprom_writes'), 0)
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._queue = []        # heap of (due time, n, bytes)
+        self._n = 0
+        self._out = bytearray() # replies due, not read yet
+        self._d4 = False
+        self._in = d4.PacketBuffer()
+        self._credit = {}       # {cid: credit the host has}
+        self._nctx = 0
+
+    @property
+    def fingerprint(self):
+        return self.info
+
+    def __enter__(self):
+        self._nctx += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._nctx -= 1
+
+    def __str__(self):
+        return f'sim:{self.model}:{self.serial_number}'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.model!r})'
+
+    # transport
+
+    def write(self, data):
+        with self._cond:
+            self.stats['writes'] += 1
+            if not self._d4:
+                if ENTER_D4 in data:
+                    self._d4 = True
+                    self._in = d4.PacketBuffer()
+                    self._reply(ENTER_D4_REPLY)
+            else:
+                self._in.feed(data)
+                for (header, payload) in self._in:
+                    self._on_packet(header, payload)
+        return len(data)
+
+    def read(self, size=None, timeout=None):
+        "Returns replies due, waiting up to `timeout` s (if None: for the next one queued)"
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._queue and self._queue[0][0] <= now:
+                    self._out += heapq.heappop(self._queue)[2]
+                if self._out or (end is not None and now >= end) or (end is None and not self._queue):
+                    break
+                due = self._queue[0][0] if self._queue else end
+                self._cond.wait(due - now if end is None else min(due, end) - now)
+            b = bytes(self._out[:size or self.max_packet])
+            del self._out[:len(b)]
+            return b
+
+    def _reply(self, b):
+        if self.loss and self._random.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+        self.stats['replies'] += 1
+        due = time.monotonic() + self.latency + self._random.uniform(0, self.jitter)
+        self._n += 1
+        heapq.heappush(self._queue, (due, self._n, b))
+        self._cond.notify_all()
+
+    def _send(self, payload, cid=(0, 0), credit=1):
+        self._reply(d4.D4Link.protocol.encode(payload, *cid, credit))
+
+    # IEEE 1284.4
+
+    @property
+    def _protocol(self):
+        return d4.REVISIONS[self.revision]
+
+    def _on_packet(self, header, payload):
+        if header.cid == (0, 0):
+            return self._on_transaction(payload)
+        if self._credit.get(header.cid, 0) <= 0:
+            return self._send(self._protocol.encode('Error', *header.cid, 0x81))
+        self._credit[header.cid] -= 1
+        if header.cid == (SERVICES['EPSON-CTRL'],) * 2:
+            self._send(self._on_control(payload), header.cid, 0)
+
+    def _on_transaction(self, payload):
+        prot = self._protocol
+        try:
+            p = prot.decode(payload)
+        except Exception:
+            return self._send(prot.encode('Error', 0, 0, 0x80))
+        reply = lambda *a: self._send(prot.encode(p.name + 'Reply', *a))
+        if p.name == 'Init':
+            reply(0x00 if p.revision == self.revision else 0x02, self.revision)
+        elif p.name == 'Exit':
+            reply(0x00)
+            self._d4 = False
+            self._credit.clear()
+        elif p.name == 'OpenChannel':
+            n = self._grant((p.sidP, p.sidS), p.maxCredit)
+            reply(0x00, p.sidP, p.sidS, p.maxPTS, p.maxSTP, p.maxCredit, n)
+        elif p.name == 'CloseChannel':
+            self._credit.pop((p.sidP, p.sidS), None)
+            reply(0x00, p.sidP, p.sidS)
+        elif p.name == 'CreditRequest':
+            asked = getattr(p, prot.CREDIT_FIELDS['CreditRequest'])
+            reply(0x00, p.sidP, p.sidS, self._grant((p.sidP, p.sidS), asked))
+        elif p.name == 'Credit':
+            reply(0x00, p.sidP, p.sidS)
+        elif p.name == 'GetSocketID':
+            sid = SERVICES.get(p.serviceName)
+            reply(0x00 if sid else 0x0A, sid or 0, p.serviceName)
+        elif p.name == 'GetServiceName':
+            name = dict((v, k) for (k, v) in SERVICES.items()).get(p.socketID)
+            reply(0x00 if name else 0x0A, p.socketID, name or '')
+        else:
+            self._send(prot.encode('Error', 0, 0, 0x87))
+
+    def _grant(self, cid, asked):
+        n = min(self.credit, asked) if asked else self.credit
+        self._credit[cid] = self._credit.get(cid, 0) + n
+        return n
+
+    # control channel
+
+    def _on_control(self, m):
+        cmd, payload = m[:2], m[4:4 + struct.unpack_from('<H', m, 2)[0]]
+        if cmd == b'di':
+            return b'@EJL ID\r\n' + self.id_string.encode('ascii')
+        if cmd == b'st':
+            return b'@BDC ST2\r\n' + struct.pack('<H', 3) + b'\x01\x01\x04\x0c'
+        if cmd == b'||':
+            rkey, c = struct.unpack_from('<HB', payload)
+            if rkey != self.rkey:
+                return b'@BDC PS\r\n||:NA;\x0c'
+            args = payload[5:]
+            if c == 0x41:       # read
+                a = struct.unpack_from('<H' if self.spec.rlen == 2 else '<B', args)[0]
+                self.stats['reads'] += 1
+                return b'@BDC PS\r\nEE:%0*X%02X;\x0c' % (2 * self.spec.rlen, a, self.mem.get(a, 0))
+            if c == 0x42:       # write
+                fmt = '<HB' if self.spec.wlen == 2 else '<BB'
+                a, v = struct.unpack_from(fmt, args)
+                key = args[struct.calcsize(fmt):]
+                if self.wkey is not None and key != self.wkey:
+                    return b'@BDC PS\r\n||:42:NA;\x0c'
+                self.mem[a] = v
+                self.stats['eeprom_writes'] += 1
+                return b'@BDC PS\r\n||:42:OK;\x0c'
+        return b'@BDC PS\r\n' + cmd + b':NA;\x0c'
+
+
+def bench(sim, addr=range(0x100), windows=(1, 4, 16), number=3) -> dict:
+    "Returns {window: EEPROM reads per second} of the whole stack against `sim`"
+    from . import UsbDevice
+    e = UsbDevice(sim).epson
+    res = {}
+    with e.link.session(e.ctrl_channel):
+        for w in windows:
+            t = time.perf_counter()
+            for _ in range(number):
+                r = e.read_eeprom(*addr, window=w)
+                assert all(v is not None for (a, v) in r)
+            res[w] = number * len(addr) / (time.perf_counter() - t)
+    return res
+
+
+if __name__ == '__main__':
+    import argparse
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.sim",
+        description="Benchmark EEPROM reads through the D4 stack against a simulated printer")
+    c.add_argument('--model', default='XP-352')
+    c.add_argument('--revision', type=lambda x: int(x, 0), default=0x20, choices=tuple(d4.REVISIONS))
+    c.add_argument('--latency', type=float, default=0.001, help="Reply delay (s)")
+    c.add_argument('--jitter', type=float, default=0.0, help="Added random delay, up to (s)")
+    c.add_argument('--loss', type=float, default=0.0, help="Probability of dropping a reply")
+    c.add_argument('--reads', type=int, default=256, help="Addresses read per run")
+    c.add_argument('--window', type=int, nargs='+', default=[1, 4, 16])
+    args = c.parse_args()
+
+    sim = SimPrinter(args.model, revision=args.revision, latency=args.latency,
+                     jitter=args.jitter, loss=args.loss)
+    addr = list(sim.mem)[:args.reads]
+    for (w, rate) in bench(sim, addr, args.window).items():
+        print(f'window {w}:\t{rate:.0f} reads/s')
+    print(sim.stats)
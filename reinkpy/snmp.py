@@ -1,69 +1,302 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
+"""SNMP GET client
+
+v1 and v2c requests use the built-in codec (see `ber`); v3 needs pysnmp.
+"""
 __all__ = (
     'SNMPLink',
 )
 
-from pysnmp.hlapi import *
-import contextlib, functools
+from . import ber
+import asyncio, contextlib, functools, itertools, random, typing
 import logging
 _log = logging.getLogger(__name__)
 del logging
 
 
+NO_RESPONSE = 'No SNMP response received before timeout'
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    "Dispatches responses to pending requests by request-id"
+
+    def __init__(self):
+        self.pending = {}       # request-id: future
+
+    def datagram_received(self, data, addr):
+        try:
+            r = ber.decode_response(data)
+        except ValueError as e:
+            _log.debug('Invalid response from %s: %s', addr, e)
+            return
+        fut = self.pending.pop(r[2], None)
+        if fut is not None and not fut.done():
+            fut.set_result(r)
+
+    def error_received(self, exc):
+        _log.debug('UDP error: %s', exc)
+
+
 class SNMPLink:
 
     OID_PRINTER = '1.3.6.1.2.1.43'
     OID_ENTERPRISE = '1.3.6.1.4.1'
     OID_ppmPrinterIEEE1284DeviceId = OID_ENTERPRISE + '.2699.1.2.1.2.1.1.3.1'
 
+    timeout = 1.0               # per attempt (s)
+    retries = 5
+    max_size = 1400             # budget for one request or response message (bytes)
+
     def __init__(self, ip, port=161, version='1', user='public'): # 'admin'
         self.ip = ip
         self.port = port
         assert version in ('1', '2c', '3')
         self.version = version
         self.user = user
-        # ObjectType(ObjectIdentity('SNMPv2-MIB', 'system'))# ('system', None)
-        # self._engine.unregisterTransportDispatcher()
+        self._ids = itertools.count(random.getrandbits(30))
+        self._udp = None        # (loop, transport, protocol)
+
+    @property
+    def builtin(self) -> bool:
+        "Whether requests go through the built-in codec rather than pysnmp"
+        return self.version in ber.VERSIONS
+
+    @functools.cached_property
+    def _loop(self):
+        return asyncio.new_event_loop()
+
+    def close(self):
+        if self._udp:
+            self._udp[1].close()
+            self._udp = None
+        if self._close_engine() and '_loop' in self.__dict__:
+            with contextlib.suppress(Exception):
+                self._loop.run_until_complete(asyncio.sleep(0)) # let tasks cancel
+        if '_loop' in self.__dict__:
+            self._loop.close()
+            del self._loop
+
+    def _oid(self, oid):
+        return getattr(self, f'OID_{oid}', oid)
+
+    async def arequest(self, *oids):
+        """Sends one GET for all `oids`
+
+        Returns (errorIndication, errorStatus, errorIndex, [(oid, value)]),
+        values being bytes, int, str or None.
+        """
+        oids = [self._oid(o) for o in oids]
+        if self.builtin:
+            return await self._arequest(oids)
+        return await self._arequest_pysnmp(oids)
+
+    def request(self, *oids):
+        "Blocking `arequest`, run on the link's own event loop"
+        return self._loop.run_until_complete(self.arequest(*oids))
+
+    async def _arequest(self, oids):
+        loop = asyncio.get_running_loop()
+        if self._udp is None or self._udp[0] is not loop:
+            tr, pr = await loop.create_datagram_endpoint(
+                _Protocol, remote_addr=(self.ip, self.port))
+            self._udp = (loop, tr, pr)
+        _, tr, pr = self._udp
+        rid = next(self._ids) & 0x7fffffff
+        msg = ber.encode_get(rid, oids, self.user.encode(), ber.VERSIONS[self.version])
+        pr.pending[rid] = fut = loop.create_future()
+        try:
+            for _ in range(self.retries + 1):
+                tr.sendto(msg)
+                try:
+                    _, _, _, eStat, eIdx, varBinds = await asyncio.wait_for(
+                        asyncio.shield(fut), self.timeout)
+                except TimeoutError:
+                    continue
+                return None, eStat, eIdx, varBinds
+            return NO_RESPONSE, 0, 0, []
+        finally:
+            pr.pending.pop(rid, None)
+
+    # pysnmp fallback, for v3: one engine and transport per link and loop
+
+    def _close_engine(self) -> bool:
+        if '_engine' not in self.__dict__:
+            return False
+        with contextlib.suppress(Exception):
+            self._engine.transportDispatcher.closeDispatcher()
+        del self._engine
+        self.__dict__.pop('_target', None)
+        return True
+
+    @functools.cached_property
+    def _engine(self):
+        from pysnmp.hlapi import SnmpEngine
+        return SnmpEngine()
 
-    def _get_cmd(self, oid):
+    @functools.cached_property
+    def _target(self):
+        "LCD target name (must be set up from within the engine's loop)"
+        from pysnmp.hlapi import CommunityData, UsmUserData
+        from pysnmp.hlapi.asyncio import UdpTransportTarget
+        from pysnmp.hlapi.lcd import CommandGeneratorLcdConfigurator
         if self.version == '1':
             auth = CommunityData(self.user, mpModel=0)
         elif self.version == '2c':
             auth = CommunityData(self.user, mpModel=1)
         else:
             auth = UsmUserData(self.user)
-        engine = SnmpEngine()
-        # TMPFIX: ensure running loop
-        import asyncio
-        try: asyncio.get_running_loop()
-        except RuntimeError: asyncio.set_event_loop(asyncio.new_event_loop())
-        return getCmd(
-            engine,
-            auth,
-            UdpTransportTarget((self.ip, self.port)),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid), None),
-            lookupMib=True
-        )
-
-    def get(self, oid):
-        oid = getattr(self, f'OID_{oid}', oid)
-        eInd, eStat, eIdx, varBinds = self._get_cmd(oid) #_iget.send((oid, None))
+        addr, params = CommandGeneratorLcdConfigurator().configure(
+            self._engine, auth,
+            UdpTransportTarget((self.ip, self.port), timeout=self.timeout,
+                               retries=self.retries),
+            b'')
+        return addr
+
+    async def _arequest_pysnmp(self, oids):
+        from pysnmp.entity.rfc3413.cmdgen import GetCommandGenerator
+        from pysnmp.proto.rfc1902 import ObjectName, Null
+        loop = asyncio.get_running_loop()
+        if self.__dict__.get('_engine_loop', loop) is not loop:
+            self._close_engine()
+        self._engine_loop = loop
+        fut = loop.create_future()
+        def cb(engine, handle, eInd, eStat, eIdx, varBinds, ctx):
+            if not fut.done():
+                fut.set_result((eInd and str(eInd), int(eStat), int(eIdx),
+                                [(str(n), _from_pyasn1(v)) for (n, v) in varBinds]))
+        GetCommandGenerator().sendVarBinds(
+            self._engine, self._target, None, b'',
+            [(ObjectName(o), Null('')) for o in oids], cb)
+        return await fut
+
+    async def aget(self, *oids):
+        "Returns [(oid, value)] of `oids`, or None on error"
+        eInd, eStat, eIdx, varBinds = await self.arequest(*oids)
         if eInd:
             _log.warn(eInd)
         elif eStat:
-            _log.warn('%s at %s', eStat.prettyPrint(),
-                      varBinds[int(eIdx) - 1][0] if eIdx else '?')
+            _log.warn('%s at %s', _error_name(eStat),
+                      varBinds[eIdx - 1][0] if 0 < eIdx <= len(varBinds) else '?')
         else:
-            _log.debug('\n'.join((v.prettyPrint() for v in varBinds)))
+            _log.debug('%r', varBinds)
             return varBinds
 
+    def get(self, *oids):
+        "Blocking `aget`"
+        return self._loop.run_until_complete(self.aget(*oids))
+
+    def iget(self, oids, reply_size=0) -> typing.Iterator:
+        """Yields the values of `oids` in order, packing as many per GET as fit `max_size`
+
+        reply_size -- expected size of each value, counted in the budget
+        Yields None for OIDs the agent reports an error on.
+        """
+        for batch in self._ibatches(oids, reply_size):
+            yield from self._loop.run_until_complete(self._aget_batch(batch))
+
+    async def aiget(self, oids, reply_size=0) -> typing.AsyncIterator:
+        "Async `iget`"
+        for batch in self._ibatches(oids, reply_size):
+            for v in await self._aget_batch(batch):
+                yield v
+
+    def _ibatches(self, oids, reply_size):
+        base = 32 + len(self.user) # message and PDU headers
+        batch, size = [], base
+        for oid in map(self._oid, oids):
+            n = ber.tlv_size(len(ber.encode_oid(oid)) + max(2, ber.tlv_size(reply_size)))
+            if batch and size + n > self.max_size:
+                yield batch
+                batch, size = [], base
+            batch.append(oid)
+            size += n
+        if batch:
+            yield batch
+
+    async def _aget_batch(self, oids) -> list:
+        if not oids:
+            return []
+        eInd, eStat, eIdx, varBinds = await self.arequest(*oids)
+        if eInd:
+            raise OSError(f'SNMP {self.ip}: {eInd}')
+        if not eStat:
+            return [v for (n, v) in varBinds]
+        i = eIdx - 1
+        if len(oids) == 1:
+            _log.warn('%s at %s', _error_name(eStat), oids[0])
+            return [None]
+        elif eStat != 1 and 0 <= i < len(oids): # not tooBig: skip the culprit
+            return (await self._aget_batch(oids[:i]) + await self._aget_batch(oids[i:i+1])
+                    + await self._aget_batch(oids[i+1:]))
+        else:
+            _log.debug('%s for %i var-binds, splitting', _error_name(eStat), len(oids))
+            h = len(oids) // 2
+            return await self._aget_batch(oids[:h]) + await self._aget_batch(oids[h:])
+
     @functools.cached_property
     def info(self) -> dict:
-        try:
-            r = self.get('ppmPrinterIEEE1284DeviceId')[0][1].asOctets().decode('ascii')
-            from . import _parse_ieee1284_id
-            return _parse_ieee1284_id(r)
-        except:
-            _log.exception('Reading IEEE 1284 device id failed.')
-            return {}
+        return self._loop.run_until_complete(self.ainfo())
+
+    async def ainfo(self) -> dict:
+        "Async `info`, caching it as well"
+        if 'info' not in self.__dict__:
+            try:
+                r = (await self.aget('ppmPrinterIEEE1284DeviceId'))[0][1].decode('ascii')
+                from . import _parse_ieee1284_id
+                self.__dict__['info'] = _parse_ieee1284_id(r)
+            except:
+                _log.exception('Reading IEEE 1284 device id failed.')
+                self.__dict__['info'] = {}
+        return self.info
+
+
+def _error_name(status):
+    return ber.ERRORS[status] if 0 <= status < len(ber.ERRORS) else f'error {status}'
+
+
+def _from_pyasn1(v):
+    from pyasn1.type import univ
+    if isinstance(v, univ.Null):    # also noSuchObject etc.
+        return None
+    if isinstance(v, univ.OctetString):
+        return v.asOctets()
+    if isinstance(v, univ.Integer):
+        return int(v)
+    if isinstance(v, univ.ObjectIdentifier):
+        return str(v)
+    return v.prettyPrint()
+
+
+def bench(link, oid='ppmPrinterIEEE1284DeviceId', number=200):
+    "Returns GET calls per second against `link`"
+    import time
+    link.get(oid)               # warm-up: transport
+    t = time.perf_counter()
+    for _ in range(number):
+        link.get(oid)
+    return number / (time.perf_counter() - t)
+
+
+if __name__ == '__main__':
+    import argparse
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.snmp",
+        description="Query a printer over SNMP")
+    c.add_argument('ip')
+    c.add_argument('--port', type=int, default=161)
+    c.add_argument('--version', choices=('1', '2c', '3'), default='1')
+    c.add_argument('--user', default='public', help="Community (v1/v2c) or user name (v3)")
+    c.add_argument('--oid', default='ppmPrinterIEEE1284DeviceId')
+    c.add_argument('--bench', type=int, metavar='N',
+                   help="Time N requests and print calls per second")
+    args = c.parse_args()
+
+    link = SNMPLink(args.ip, args.port, args.version, args.user)
+    try:
+        if args.bench:
+            print('%.1f calls/s' % bench(link, args.oid, args.bench))
+        else:
+            for (n, v) in link.get(args.oid) or ():
+                print(n, '=', v)
+    finally:
+        link.close()
@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Finding network printers by sweeping address ranges with SNMP GETs
+
+For networks where mDNS does not get through. All hosts share one UDP
+socket; requests are paced at `rate` per second.
+"""
+__all__ = (
+    'asweep',
+    'isweep',
+)
+
+from . import ber, _parse_ieee1284_id
+from .snmp import SNMPLink
+import asyncio, ipaddress, itertools, random, socket
+import logging
+_log = logging.getLogger(__name__)
+del logging
+
+
+class _Protocol(asyncio.DatagramProtocol):
+
+    def __init__(self, on_datagram):
+        self.datagram_received = on_datagram
+
+    def error_received(self, exc):
+        pass                    # e.g. ICMP unreachable from non-agents
+
+
+async def asweep(network, brand='EPSON', rate=2000, timeout=1.0, retries=1,
+                 community='public', port=161, max_hosts=1 << 16):
+    """Yields (ip, info) of hosts in `network` answering with a printer device ID
+
+    network -- CIDR, e.g. '192.168.0.0/22', or addresses
+    brand -- keep only devices whose MFG matches (None: all)
+    rate -- requests per second
+    timeout -- time to wait for late answers after each round (s)
+    retries -- rounds resent to silent hosts
+    max_hosts -- larger networks are refused (ValueError)
+    """
+    if isinstance(network, str):
+        net = ipaddress.ip_network(network, strict=False)
+        if net.num_addresses > max_hosts:
+            raise ValueError(f'Network {net} too large to sweep: over {max_hosts} hosts')
+        ihosts = lambda: map(str, net.hosts()) # iterated once per round
+        n = net.num_addresses
+        version = net.version
+    else:
+        hosts = list(network)
+        ihosts = lambda: iter(hosts)
+        n = len(hosts)
+        net = 'listed addresses'
+        version = ipaddress.ip_address(hosts[0]).version if hosts else 4
+    rid = random.getrandbits(30)
+    msg = ber.encode_get(rid, [SNMPLink.OID_ppmPrinterIEEE1284DeviceId],
+                         community.encode(), ber.VERSIONS['1'])
+    answered = set()
+    found = asyncio.Queue()
+
+    def on_datagram(data, addr):
+        ip = addr[0]
+        if ip in answered:
+            return
+        try:
+            _, _, r, eStat, _, vbs = ber.decode_response(data)
+        except ValueError:
+            return
+        if r != rid or eStat or not vbs or not isinstance(vbs[0][1], bytes):
+            return
+        answered.add(ip)
+        info = _parse_ieee1284_id(vbs[0][1].decode('ascii', 'replace')) or {}
+        if brand is None or info.get('MFG', '').upper() == brand.upper():
+            found.put_nowait((ip, info))
+
+    async def send():
+        burst = max(1, rate // 100)
+        for i in range(retries + 1):
+            _log.debug('Sweep round %i: %i hosts answered', i, len(answered))
+            todo = (h for h in ihosts() if h not in answered)
+            while batch := list(itertools.islice(todo, burst)):
+                for h in batch:
+                    tr.sendto(msg, (h, port))
+                await asyncio.sleep(burst / rate)
+            await asyncio.sleep(timeout)
+        found.put_nowait(None)
+
+    loop = asyncio.get_running_loop()
+    tr, _ = await loop.create_datagram_endpoint(
+        lambda: _Protocol(on_datagram),
+        local_addr=('::' if version == 6 else '0.0.0.0', 0),
+        family=socket.AF_INET6 if version == 6 else socket.AF_INET)
+    sender = asyncio.ensure_future(send())
+    try:
+        _log.info('Sweeping %s (%i addresses)...', net, n)
+        while (r := await found.get()) is not None:
+            yield r
+    finally:
+        sender.cancel()
+        tr.close()
+
+
+def isweep(network, stop=None, **kw):
+    """Blocking `asweep`
+
+    stop -- threading.Event to end the sweep early
+    """
+    loop = asyncio.new_event_loop()
+    it = asweep(network, **kw)
+    try:
+        while not (stop and stop.is_set()):
+            try:
+                yield loop.run_until_complete(anext(it))
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(it.aclose())
+        loop.close()
+
+
+if __name__ == '__main__':
+    import argparse, time
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.sweep",
+        description="Find printers in address ranges by SNMP")
+    c.add_argument('network', nargs='+', help="CIDR, e.g. 192.168.0.0/22")
+    c.add_argument('--all', action='store_true', help="Not only EPSON devices")
+    c.add_argument('--rate', type=int, default=2000, help="Requests per second")
+    c.add_argument('--timeout', type=float, default=1.0)
+    c.add_argument('--port', type=int, default=161)
+    args = c.parse_args()
+
+    async def main():
+        t = time.monotonic()
+        for n in args.network:
+            async for (ip, info) in asweep(n, None if args.all else 'EPSON', args.rate,
+                                           args.timeout, port=args.port):
+                print(f"{ip}\t{info.get('MFG')}\t{info.get('MDL')}", flush=True)
+        _log.info('Done in %.2f s', time.monotonic() - t)
+
+    asyncio.run(main())
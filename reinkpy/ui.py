@@ -64,12 +64,27 @@ class App:
         run_sep(self.find_devices)
 
     def find_devices(self):
-        res = Device.find()
-        self.device.options = [('Select device…', None), *((str(d), d) for d in res)]
+        res = []
+        head = ['Scanning for devices…']
+        def relabel(*_):        # as printer IDs come in, shown at the next frame
+            self._device_options = [(head[0], None), *((str(d), d) for d in res)]
+        for d in Device.ifind():
+            res.append(d)
+            relabel()
+            d.prefetch().add_done_callback(relabel)
+        head[0] = 'Select device…'
+        relabel()
         if res:
             # self.device.value = self.device.options[1][1]
             self.device.focus()
-        self._needs_refresh = True
+
+    _device_options = None      # pending update of the device list
+
+    def _update_devices(self):
+        "Sets the pending device list in place, keeping the selection"
+        if (o := self._device_options) is not None:
+            self._device_options = None
+            self.device.options = o
 
     def device_changed(self):
         self.brand.disabled = self.device.value is None
@@ -145,6 +160,7 @@ class App:
                         leave = False
                         break
                     else:
+                        self._update_devices()
                         screen.draw_next_frame()
                         await asyncio.sleep(0.1)
             except am.exceptions.StopApplication:
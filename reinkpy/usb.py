@@ -41,8 +41,13 @@ class UsbIO:
         _log.debug('Writing...:\n%r', hexdump(data))
         return self.epOut.write(data)
 
-    def read(self, size=None):
-        res = self.epIn.read(size or self.epIn.wMaxPacketSize)
+    def read(self, size=None, timeout=None):
+        "Returns b'' if nothing was received within `timeout` seconds"
+        try:
+            res = self.epIn.read(size or self.epIn.wMaxPacketSize,
+                                 None if timeout is None else max(1, int(timeout * 1000)))
+        except usb.core.USBTimeoutError:
+            return b''
         _log.debug('Received %iB:\n%s', len(res), hexdump(res))
         return res
 
@@ -104,6 +109,11 @@ class UsbIO:
         return dict([(k, getattr(self.dev, k)) for k in DEVICE_FIELDS] +
                     [(k, getattr(self.ifc, k)) for k in IFACE_FIELDS])
 
+    @property
+    def fingerprint(self):
+        "USB descriptors, to check identities cached for this port against"
+        return self.info
+
 
 def iter_interfaces(bClass=BCLASS_PRINTER,  # match bDeviceClass or bInterfaceClass
                     **spec):
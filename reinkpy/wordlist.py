@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Wordlists of candidate keys
+
+Key files hold one key per line (`.Keys8`), or fixed-width keys with no
+separator (`.bin`, as written by `generate`). They are read through mmap,
+lazily, so that files of millions of keys cost no more memory than the
+keys already seen.
+
+`generate` makes EPSON-style write keys from words, e.g. taxon names (see
+wordlists/Makefile): capitalized, padded with '.' to 8 and Caesar-shifted
+by one ('Malvacea' -> 'Nbmwbdfb').
+"""
+__all__ = (
+    'iread',
+    'unique',
+    'caesar',
+    'to_key',
+    'generate',
+)
+
+import array, mmap, os, re, sys, typing
+
+
+def iread(path, size=8) -> typing.Iterator[bytes]:
+    """Yields the keys of a key file
+
+    Lines not `size` bytes long are skipped; `.bin` files are read as
+    fixed-width keys.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if os.fspath(path).endswith('.bin'):
+                for i in range(0, len(m) - size + 1, size):
+                    yield m[i:i+size]
+            else:
+                for line in iter(m.readline, b''):
+                    line = line.rstrip(b'\r\n')
+                    if len(line) == size:
+                        yield line
+
+
+def unique(keys: typing.Iterable) -> typing.Iterator:
+    "Yields keys not yielded before"
+    seen = set()
+    for k in keys:
+        if k not in seen:
+            seen.add(k)
+            yield k
+
+
+def caesar(b: bytes, shift=1) -> bytes|None:
+    "b with each byte shifted, or None if that leaves printable ASCII"
+    r = bytes((c + shift) & 0xff for c in b)
+    return r if all(0x20 <= c < 0x7f for c in r) else None
+
+
+# Key generation. Tables map each byte to its Caesar-shifted upper / lower case.
+_SHIFT = bytes((i + 1) & 0xff for i in range(256))
+_UPPER = bytes(_SHIFT[i - 32 if 0x61 <= i <= 0x7a else i] for i in range(256))
+_LOWER = bytes(_SHIFT[i + 32 if 0x41 <= i <= 0x5a else i] for i in range(256))
+_PAD = b'.'.translate(_SHIFT)
+_HEAD = re.compile(rb'^.{8}', re.M)  # of each line
+_BLANK = re.compile(rb'\n\n+')
+
+
+def to_key(word: bytes) -> bytes:
+    "Write key made from word: 'malvaceae' -> b'Nbmwbdfb'"
+    return (word[:1].translate(_UPPER) + word[1:8].translate(_LOWER)).ljust(8, _PAD)
+
+
+def _block_keys(block: bytes) -> array.array:
+    "Keys of the lines of block, each once, as 64-bit ints (non-ASCII lines skipped)"
+    if not block.isascii():
+        block = b'\n'.join(l for l in block.split(b'\n') if l.isascii())
+    if b'\r' in block:
+        block = block.replace(b'\r', b'')
+    block = _BLANK.sub(b'\n', block).strip(b'\n')
+    if not block:
+        return array.array('Q')
+    # padded lines' heads (`to_key` on each line, but through regex and tables)
+    raw = b''.join(_HEAD.findall(block.replace(b'\n', b'........\n') + b'........'))
+    keys = bytearray(raw.translate(_LOWER))
+    keys[0::8] = raw[0::8].translate(_UPPER)
+    return array.array('Q', dict.fromkeys(memoryview(keys).cast('Q'))) # deduplicated
+
+
+def _iblocks(files, size):
+    "Yields blocks of whole lines"
+    for f in files:
+        rest = b''
+        while b := f.read(size):
+            b, nl, rest = (rest + b).rpartition(b'\n')
+            if nl:
+                yield b
+        if rest:
+            yield rest
+
+
+def _imap(f, it, jobs):
+    "Ordered map over a process pool, keeping a bounded number of tasks pending"
+    if jobs == 1:
+        yield from map(f, it)
+        return
+    import collections, concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for x in it:
+            pending.append(pool.submit(f, x))
+            if len(pending) > 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def generate(inputs, output, jobs=None, text=False, block_size=1 << 22) -> int:
+    """Writes the keys of the words of `inputs` (files, one word per line) to `output`
+
+    Keys are written once each, in order of first occurrence: fixed-width
+    (see `iread`), or one per line if `text`. Blocks of lines are turned
+    into keys in `jobs` processes (default: one per CPU). Returns the
+    number of keys written.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    seen = set()                # keys as 64-bit ints
+    n = 0
+    for keys in _imap(_block_keys, _iblocks(inputs, block_size), jobs):
+        fresh = set(keys).difference(seen)
+        a = keys if len(fresh) == len(keys) else array.array('Q', (k for k in keys if k in fresh))
+        seen |= fresh
+        if text:
+            b = a.tobytes()
+            output.write(b''.join(b[i:i+8] + b'\n' for i in range(0, len(b), 8)))
+        else:
+            a.tofile(output)
+        n += len(a)
+    return n
+
+
+if __name__ == '__main__':
+    import argparse, time
+    c = argparse.ArgumentParser(
+        prog="python -m reinkpy.wordlist",
+        description="Make write keys from words (one per line)")
+    c.add_argument('input', nargs='*', help="Word files (default: stdin)")
+    c.add_argument('-o', '--output', help="Key file (default: stdout)")
+    c.add_argument('--text', action='store_true', help="One key per line, not fixed-width")
+    c.add_argument('--jobs', type=int, help="Processes (default: one per CPU)")
+    args = c.parse_args()
+
+    t = time.monotonic()
+    files = [open(p, 'rb') for p in args.input] or [sys.stdin.buffer]
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    with out:
+        n = generate(files, out, args.jobs, args.text)
+    print(f'{n} keys in {time.monotonic() - t:.2f} s', file=sys.stderr)
@@ -1,53 +1,246 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
+"""Finding network printers by mDNS / DNS-SD
+
+A `Browser` keeps a registry of services, resolved concurrently and
+expired when not refreshed within their TTL.
+"""
 __all__ = (
     'Browser',
-    'find'
+    'Service',
+    'get_browser',
+    'find',
+    'ifind',
 )
 
 import logging
 _log = logging.getLogger(__name__)
 
 try:
-    from zeroconf import Zeroconf, ServiceStateChange, IPVersion, ServiceBrowser
+    from zeroconf import ServiceStateChange, IPVersion
+    from zeroconf.asyncio import AsyncZeroconf, AsyncServiceBrowser, AsyncServiceInfo
 except ImportError as e:
     _log.warning(e)
     AVAILABLE = False
 else:
     AVAILABLE = True
 
-import collections, time
+import asyncio, dataclasses, queue, threading, time
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Service:
+    name: str
+    type: str
+    server: str = None
+    port: int = None
+    ipv4: frozenset = frozenset()
+    ipv6: frozenset = frozenset()
+    expires: float = 0.0        # time.monotonic()
+
+    @property
+    def addresses(self) -> frozenset:
+        return self.ipv4 | self.ipv6
 
 
 class Browser:
 
+    ttl = 120                   # s, without refresh (mDNS host record TTL)
+    resolve_timeout = 3.0       # s
+
     def __init__(self, types=('_ipp._tcp.local.','_ipps._tcp.local.','_printer._tcp.local.')):
-        self.by_type = dict((k,{}) for k in types)
-        self.by_addr = collections.ChainMap(*self.by_type.values())
-        self.zc = Zeroconf() # ip_version=IPVersion.V4Only
+        self.types = list(types)
+        self._services = {}     # name: Service
+        self._lock = threading.Lock()
+        self._listeners = []    # callables, passed each new or updated Service
+        self._tasks = set()
+        self._loop = None
+        self.azc = None
+
+    # registry
+
+    def services(self) -> list[Service]:
+        "Live services"
+        now = time.monotonic()
+        with self._lock:
+            return [s for s in self._services.values() if s.expires > now]
+
+    @property
+    def by_addr(self) -> dict:
+        "{addr: name} of live services"
+        return dict((a, s.name) for s in self.services() for a in sorted(s.addresses))
+
+    def _update(self, s: Service):
+        with self._lock:
+            prev = self._services.get(s.name)
+            self._services[s.name] = s
+        if prev is None or prev.addresses != s.addresses:
+            _log.info('Service %s at %s', s.name, ', '.join(sorted(s.addresses)))
+            for cb in list(self._listeners):
+                cb(s)
+
+    def _remove(self, name):
+        with self._lock:
+            self._services.pop(name, None)
+
+    # running in an event loop
+
+    async def astart(self):
+        "Start browsing in the running loop"
+        self._loop = asyncio.get_running_loop()
+        self.azc = AsyncZeroconf()
+        self.browser = AsyncServiceBrowser(self.azc.zeroconf, self.types,
+                                           handlers=[self.on_change])
+        self._spawn(self._refresh())
+        return self
+
+    async def aclose(self):
+        for t in list(self._tasks):
+            t.cancel()
+        await self.browser.async_cancel()
+        await self.azc.async_close()
+
+    def _spawn(self, coro):
+        t = asyncio.ensure_future(coro)
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    def on_change(self, zeroconf, service_type: str, name: str,
+                  state_change) -> None:
+        # called in the loop: must not block
+        _log.debug(f"Service {name} of type {service_type} changed: {state_change.name}")
+        if state_change is ServiceStateChange.Removed:
+            self._remove(name)
+        else:
+            self._spawn(self._resolve(service_type, name))
+
+    async def _resolve(self, service_type, name):
+        info = AsyncServiceInfo(service_type, name)
+        if not await info.async_request(self.azc.zeroconf, self.resolve_timeout * 1000):
+            _log.debug('Resolving %s failed', name)
+            return
+        self._update(Service(
+            name, service_type, info.server, info.port,
+            frozenset(info.parsed_scoped_addresses(IPVersion.V4Only)),
+            frozenset(info.parsed_scoped_addresses(IPVersion.V6Only)),
+            time.monotonic() + self.ttl))
+
+    async def _refresh(self):
+        "Re-resolves services nearing expiry; unanswered ones lapse"
+        while True:
+            await asyncio.sleep(self.ttl / 10)
+            soon = time.monotonic() + self.ttl / 5
+            with self._lock:
+                due = [s for s in self._services.values() if s.expires < soon]
+            for s in due:
+                if s.expires < time.monotonic():
+                    self._remove(s.name)
+                else:
+                    self._spawn(self._resolve(s.type, s.name))
+
+    async def aiscan(self, duration, known=True):
+        """Yields services as they are found during `duration` (s)
+
+        known -- first yield the live services already in the registry
+        """
+        q = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        cb = lambda s: loop.call_soon_threadsafe(q.put_nowait, s)
+        self._listeners.append(cb)
+        try:
+            if known:
+                for s in self.services():
+                    yield s
+            end = time.monotonic() + duration
+            while (left := end - time.monotonic()) > 0:
+                try:
+                    yield await asyncio.wait_for(q.get(), left)
+                except TimeoutError:
+                    pass
+        finally:
+            self._listeners.remove(cb)
+
+    # running in a background thread
+
+    def start(self):
+        "Start browsing in a background thread, if not yet started"
+        if self._loop is None:
+            started = threading.Event()
+            error = []
+            def run():
+                loop = asyncio.new_event_loop()
+                try:
+                    loop.run_until_complete(self.astart())
+                except Exception as e: # e.g. no network interface
+                    error.append(e)
+                    self._loop = None
+                    loop.close()
+                    return
+                finally:
+                    started.set()
+                loop.run_forever()
+            threading.Thread(target=run, name='zeroconf-browser', daemon=True).start()
+            started.wait()
+            if error:
+                raise error[0]
+        return self
+
+    def close(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+    def iscan(self, duration, stop=None, known=True):
+        """Yields (addr, name) of services as they are found during `duration` (s)
+
+        stop -- threading.Event to end the scan early
+        known -- first yield the live services already in the registry
+        """
+        self.start()
+        q = queue.Queue()
+        self._listeners.append(q.put)
+        try:
+            seen = set()
+            if known:
+                for s in self.services():
+                    q.put(s)
+            end = time.monotonic() + duration
+            while (left := end - time.monotonic()) > 0 and not (stop and stop.is_set()):
+                try:
+                    s = q.get(timeout=min(left, 0.1))
+                except queue.Empty:
+                    continue
+                for a in sorted(s.addresses - seen):
+                    seen.add(a)
+                    yield a, s.name
+        finally:
+            self._listeners.remove(q.put)
 
     def run(self, duration):
-        # starts a thread
-        with ServiceBrowser(self.zc, list(self.by_type.keys()), handlers=[self.on_change]):
-            _log.info('Looking for network devices (%s sec)...', duration)
-            time.sleep(duration)
+        for _ in self.iscan(duration):
+            pass
         return self
 
-    def on_change(self, zeroconf: Zeroconf, service_type: str, name: str,
-                  state_change: ServiceStateChange) -> None:
-        _log.info(f"Service {name} of type {service_type} changed: ${state_change.name}")
-        info = zeroconf.get_service_info(service_type, name)
-        _log.debug(f"{info}")
-        d = self.by_type[service_type]
-        name = info.get_name()
-        for a in info.parsed_scoped_addresses():
-            if state_change in (ServiceStateChange.Added, ServiceStateChange.Updated):
-                d[a] = name
-            elif state_change is ServiceStateChange.Removed:
-                d.pop(a, None)
+
+_browser = None
+
+def get_browser() -> Browser:
+    "The shared `Browser`, running in the background once started"
+    global _browser
+    if _browser is None:
+        _browser = Browser().start()
+    return _browser
 
 
 def find(timeout=5):
-    return Browser().run(timeout).by_addr.items() if AVAILABLE else ()
+    "Returns {addr: name} of network printers, after scanning `timeout` (s)"
+    return get_browser().run(timeout).by_addr.items() if AVAILABLE else ()
+
+
+def ifind(timeout=5, stop=None):
+    "Yields (addr, name) of known network printers, then of new ones as they are found"
+    if AVAILABLE:
+        yield from get_browser().iscan(timeout, stop)
 
 
 if __name__ == "__main__":